@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Benchmarks for redis-completion.
+
+A private redis-server is started on a free port, a synthetic corpus of titles
+is indexed and the results are written as JSON, so that runs can be compared
+across commits:
+
+    python benchmark.py --size 20000 --output before.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from redis import Redis
+
+from redis_completion.engine import RedisEngine
+from redis_completion.memory import MemoryEngine
+
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class RedisServer(object):
+    """
+    A throw-away redis-server, running without persistence in a temporary
+    directory
+    """
+    def __init__(self, executable='redis-server'):
+        self.executable = executable
+        self.port = free_port()
+        self.directory = tempfile.mkdtemp()
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [self.executable, '--port', str(self.port), '--bind', '127.0.0.1',
+             '--save', '', '--appendonly', 'no', '--dir', self.directory],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        client = Redis(port=self.port)
+        for i in range(100):
+            try:
+                client.ping()
+                break
+            except Exception:
+                time.sleep(.05)
+        else:
+            raise RuntimeError('redis-server did not start')
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def make_corpus(size, vocabulary, words, seed):
+    rng = random.Random(seed)
+    vocab = set()
+    while len(vocab) < vocabulary:
+        vocab.add(''.join(rng.choice(LETTERS) for i in range(rng.randint(3, 10))))
+    vocab = sorted(vocab)
+
+    return [
+        (i, ' '.join(rng.choice(vocab) for j in range(rng.randint(1, words))))
+        for i in range(size)]
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    pct = lambda p: timings[min(len(timings) - 1, int(len(timings) * p))]
+    return {
+        'n': len(timings),
+        'mean_ms': 1000 * sum(timings) / len(timings),
+        'p50_ms': 1000 * pct(.5),
+        'p95_ms': 1000 * pct(.95),
+        'p99_ms': 1000 * pct(.99),
+    }
+
+
+def used_memory(engine):
+    return engine.client.info()['used_memory']
+
+
+def bench_score_key(engine, corpus):
+    results = {}
+    keys = [engine.create_key(title) for obj_id, title in corpus]
+    for packed in (False, True):
+        engine.packed_scores = packed
+        start = time.time()
+        for k in keys:
+            engine.score_key(k)
+        results[packed and 'packed' or 'legacy'] = {
+            'scores_per_sec': len(keys) / (time.time() - start)}
+    engine.packed_scores = False
+    return results
+
+
+def bench_store(engine, corpus, sample):
+    engine.flush()
+    start = time.time()
+    for obj_id, title in corpus[:sample]:
+        engine.store(obj_id, title)
+    elapsed = time.time() - start
+    return {'objects': sample, 'objects_per_sec': sample / elapsed}
+
+
+def bench_store_many(engine, corpus, chunk_size):
+    engine.flush()
+    baseline = used_memory(engine)
+    stats = engine.store_many(corpus, chunk_size=chunk_size)
+    stats['bytes_per_object'] = float(used_memory(engine) - baseline) / len(corpus)
+    return stats
+
+
+def result_bucket(count):
+    if count < 10:
+        return '1-9'
+    elif count < 100:
+        return '10-99'
+    elif count < 1000:
+        return '100-999'
+    return '1000+'
+
+
+def bench_search(engine, corpus, queries, limit, seed):
+    rng = random.Random(seed)
+    by_length = {}
+    by_results = {}
+
+    for i in range(queries):
+        word = rng.choice(rng.choice(corpus)[1].split())
+        length = rng.randint(engine.min_length, max(engine.min_length, len(word)))
+        prefix = word[:length]
+
+        start = time.time()
+        engine.search(prefix, limit=limit)
+        elapsed = time.time() - start
+
+        matches = engine.client.zcard(engine.search_key(prefix))
+        by_length.setdefault(str(length), []).append(elapsed)
+        by_results.setdefault(result_bucket(matches), []).append(elapsed)
+
+    return {
+        'limit': limit,
+        'by_prefix_length': dict((k, percentiles(v)) for k, v in by_length.items()),
+        'by_result_size': dict((k, percentiles(v)) for k, v in by_results.items()),
+    }
+
+
+def probe_intersect(client, keys):
+    """
+    Intersect sorted sets from the client, by walking the smallest one and
+    looking its members up in the others with ZMSCORE
+    """
+    sizes = [client.zcard(key) for key in keys]
+    keys = [key for _, key in sorted(zip(sizes, keys))]
+    members = client.zrange(keys[0], 0, -1)
+    for key in keys[1:]:
+        if not members:
+            break
+        scores = client.execute_command('ZMSCORE', key, *members)
+        members = [m for m, score in zip(members, scores) if score is not None]
+    return members
+
+
+def bench_intern_ids(port, corpus, chunk_size, seed):
+    """
+    Compare the memory used per object when the corpus is stored under UUIDs,
+    with and without interning the ids
+    """
+    rng = random.Random(seed)
+    corpus = [('%032x' % rng.getrandbits(128), title) for obj_id, title in corpus]
+    results = {}
+    for intern_ids in (False, True):
+        engine = RedisEngine(prefix='bench', port=port, intern_ids=intern_ids)
+        stats = bench_store_many(engine, corpus, chunk_size)
+        results[intern_ids and 'interned' or 'strings'] = {
+            'bytes_per_object': stats['bytes_per_object'],
+            'objects_per_sec': stats['objects_per_sec']}
+        engine.flush()
+    return results
+
+
+def bench_planner(engine, large_sizes=(1000, 10000, 100000),
+                  small_sizes=(10, 100, 1000, 10000), repeat=20):
+    """
+    Time intersecting a set of ``large`` objects with a set of ``small`` of
+    them using ZINTERSTORE and by probing from the client, and a search for a
+    word that does not occur
+    """
+    results = []
+    for large in large_sizes:
+        engine.flush()
+        engine.store_many((i, 'common') for i in range(large))
+        keys = [engine.search_key('common')]
+        for small in (s for s in small_sizes if s <= large):
+            # a set holding the first ``small`` of the objects
+            rare = 'bench:planner:small'
+            engine.client.zunionstore(rare, keys)
+            engine.client.zremrangebyrank(rare, small, -1)
+
+            timings = {'zinterstore': [], 'probe': []}
+            for i in range(repeat):
+                start = time.time()
+                engine.client.zinterstore('bench:planner', keys + [rare])
+                timings['zinterstore'].append(time.time() - start)
+                engine.client.delete('bench:planner')
+
+                start = time.time()
+                probe_intersect(engine.client, keys + [rare])
+                timings['probe'].append(time.time() - start)
+
+            result = {'large': large, 'small': small}
+            for name, values in timings.items():
+                result[name] = percentiles(values)
+            results.append(result)
+
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            engine.search('common missing', limit=10)
+            timings.append(time.time() - start)
+        results.append({'large': large, 'small': 0, 'search': percentiles(timings)})
+
+    engine.flush()
+    return results
+
+
+def bench_remove(engine, corpus, sample):
+    timings = []
+    for obj_id, title in corpus[:sample]:
+        start = time.time()
+        engine.remove(obj_id)
+        timings.append(time.time() - start)
+    return percentiles(timings)
+
+
+def bench_memory(corpus, queries, chunk_size, seed):
+    engine = MemoryEngine()
+    results = {'store_many': engine.store_many(corpus, chunk_size=chunk_size)}
+
+    rng = random.Random(seed)
+    for words in (1, 2):
+        timings = []
+        for i in range(queries):
+            title = rng.choice(corpus)[1].split()
+            phrase = ' '.join(w[:rng.randint(engine.min_length, max(engine.min_length, len(w)))]
+                              for w in title[:words])
+            start = time.time()
+            engine.search(phrase, limit=10)
+            timings.append(time.time() - start)
+        results['search_%s_words' % words] = percentiles(timings)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def run(options):
+    corpus = make_corpus(options.size, options.vocabulary, options.words, options.seed)
+    sample = min(options.sample, options.size)
+
+    with RedisServer(options.redis_server) as server:
+        engine = RedisEngine(prefix='bench', port=server.port)
+        results = {
+            'revision': git_revision(),
+            'options': vars(options),
+            'score_key': bench_score_key(engine, corpus),
+            'store': bench_store(engine, corpus, sample),
+            'store_many': bench_store_many(engine, corpus, options.chunk_size),
+        }
+        results['search'] = [
+            bench_search(engine, corpus, options.queries, limit, options.seed)
+            for limit in (10, None)]
+        results['remove'] = bench_remove(engine, corpus, sample)
+
+        # about 100 records per bucket keeps the buckets small enough for the
+        # compact hash encoding
+        compact = RedisEngine(prefix='bench', port=server.port, compact_storage=True,
+                              storage_buckets=max(1, options.size // 100))
+        results['store_many_compact'] = bench_store_many(
+            compact, corpus, options.chunk_size)
+        results['intern_ids'] = bench_intern_ids(
+            server.port, corpus, options.chunk_size, options.seed)
+        results['planner'] = bench_planner(engine)
+
+    results['memory'] = bench_memory(corpus, options.queries, options.chunk_size, options.seed)
+
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of titles in the corpus')
+    parser.add_argument('--vocabulary', type=int, default=2000,
+                        help='number of distinct words in the corpus')
+    parser.add_argument('--words', type=int, default=5,
+                        help='maximum number of words per title')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='number of searches to time')
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='number of objects to store and remove individually')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='chunk size used for bulk ingest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redis-server', default='redis-server',
+                        help='path to the redis-server executable')
+    parser.add_argument('--output', help='write the results to a file')
+    options = parser.parse_args(args)
+
+    results = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(results)
+    else:
+        sys.stdout.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
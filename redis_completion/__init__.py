@@ -1 +1,4 @@
 from redis_completion.engine import RedisEngine
+from redis_completion.memory import MemoryEngine
+from redis_completion.replicated import ReplicatedEngine
+from redis_completion.sharded import ShardedEngine
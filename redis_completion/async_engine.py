@@ -0,0 +1,184 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import asyncio
+import re
+
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+
+from redis_completion.engine import BaseEngine
+from redis_completion.engine import TRANSACTION_ATTEMPTS
+
+
+class CommandBatcher(object):
+    """
+    Collects the commands issued by concurrently running coroutines and sends
+    them to redis in a single pipeline on the next iteration of the event
+    loop, so that many simultaneous searches cost one round-trip per step
+    instead of one per search.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._pending = []
+
+    def execute(self, *args):
+        future = asyncio.get_event_loop().create_future()
+        if not self._pending:
+            asyncio.ensure_future(self._flush())
+        self._pending.append((args, future))
+        return future
+
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+
+        pipe = self.client.pipeline(transaction=False)
+        for args, future in pending:
+            pipe.execute_command(*args)
+
+        try:
+            results = await pipe.execute(raise_on_error=False)
+        except Exception as exc:
+            for args, future in pending:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for (args, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class AsyncRedisEngine(BaseEngine):
+    """
+    An asyncio version of :py:class:`RedisEngine`, built on ``redis.asyncio``.
+    Ties between packed scores are not broken, so they are not supported.
+    """
+    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300,
+                 batch_size=1000, packed_scores=False, tokenizer=None, **conn_kwargs):
+        if packed_scores:
+            raise ValueError('AsyncRedisEngine does not support packed scores')
+        super(AsyncRedisEngine, self).__init__(
+            min_length, prefix, stop_words, cache_timeout, batch_size, packed_scores,
+            tokenizer)
+
+        self.conn_kwargs = conn_kwargs
+        self.client = self.get_client()
+        self.batcher = CommandBatcher(self.client)
+
+    def get_client(self):
+        return Redis(**self.conn_kwargs)
+
+    async def flush(self, everything=False, batch_size=1000):
+        generation = await self.client.get(self.generation_key)
+
+        if everything:
+            await self.client.flushdb()
+        else:
+            pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefix) + ':*'
+            batch = []
+            async for key in self.client.scan_iter(match=pattern, count=batch_size):
+                batch.append(key)
+                if len(batch) == batch_size:
+                    await self.client.unlink(*batch)
+                    batch = []
+            if batch:
+                await self.client.unlink(*batch)
+
+        await self.client.set(self.generation_key, int(generation or 0) + 1)
+
+    async def store(self, obj_id, title=None, data=None):
+        obj_id, title, data, _ = self._normalize(obj_id, title, data)
+        words = self.clean_phrase(title)
+        title_score = self.score_key(' '.join(words))
+
+        pipe = self.client.pipeline()
+        pipe.hset(self.data_key, obj_id, data)
+        pipe.hset(self.title_key, obj_id, title)
+        for partial_key in self.tokenizer.partial_keys(words):
+            pipe.zadd(self.search_key(partial_key), {obj_id: title_score})
+        pipe.incr(self.generation_key)
+        await pipe.execute()
+
+    async def store_json(self, obj_id, title, data_dict):
+        return await self.store(obj_id, title, json.dumps(data_dict))
+
+    async def remove(self, obj_id):
+        obj_id = str(obj_id)
+
+        # like RedisEngine, give up if the titles keep changing
+        async with self.client.pipeline() as pipe:
+            for attempt in range(TRANSACTION_ATTEMPTS):
+                try:
+                    await pipe.watch(self.title_key)
+                    title = await pipe.hget(self.title_key, obj_id)
+                    if isinstance(title, bytes):
+                        title = title.decode('utf-8')
+
+                    pipe.multi()
+                    for partial_key in self.partial_keys(title or ''):
+                        pipe.zrem(self.search_key(partial_key), obj_id)
+                    pipe.hdel(self.data_key, obj_id)
+                    pipe.hdel(self.title_key, obj_id)
+                    pipe.incr(self.generation_key)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    await pipe.reset()
+        raise WatchError('Watched keys changed %d times in a row' % TRANSACTION_ATTEMPTS)
+
+    async def search(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        cleaned = self.clean_phrase(phrase)
+        if not cleaned:
+            return []
+
+        # a single word is read straight from its prefix set, which must never
+        # be intersected into or given a timeout
+        if len(cleaned) == 1:
+            new_key = self.search_key(cleaned[0])
+        else:
+            generation = await self.batcher.execute('GET', self.generation_key)
+            if isinstance(generation, bytes):
+                generation = generation.decode('utf-8')
+            new_key = self.cache_key(generation, cleaned)
+            if not await self.batcher.execute('EXISTS', new_key):
+                await asyncio.gather(
+                    self.batcher.execute(
+                        'ZINTERSTORE', new_key, len(cleaned),
+                        *[self.search_key(w) for w in cleaned] + ['AGGREGATE', 'MAX']),
+                    self.batcher.execute('EXPIRE', new_key, self.cache_timeout))
+
+        data = []
+        start = offset
+        batch_size = self._first_batch_size(limit, filters)
+
+        while True:
+            obj_ids = await self.batcher.execute(
+                'ZRANGE', new_key, start, start + batch_size - 1)
+            if not obj_ids:
+                break
+
+            batch = await self.batcher.execute('HMGET', self.data_key, *obj_ids)
+            for raw_data in self._results([batch], filters, mappers):
+                data.append(raw_data)
+                if limit and len(data) == limit:
+                    return data
+
+            if len(obj_ids) < batch_size:
+                break
+
+            start += batch_size
+            batch_size = self._next_batch_size(batch_size)
+
+        return data
+
+    async def search_json(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        if not mappers:
+            mappers = []
+        mappers.insert(0, json.loads)
+        return await self.search(phrase, limit, filters, mappers, offset)
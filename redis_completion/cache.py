@@ -0,0 +1,46 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe in-process cache with LRU eviction.  Entries expire
+    after ``timeout`` seconds and are tagged with the generation of the index
+    they were computed from -- an entry is only returned if the caller asks for
+    it with the same generation.
+    """
+    def __init__(self, max_size=1000, timeout=300):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, generation=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] != generation or entry[2] < time.time():
+                self.misses += 1
+                return None
+
+            # re-insert the entry so it becomes the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, generation, time.time() + self.timeout)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -2,11 +2,27 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import copy
+import functools
 import re
+import threading
+import time
+import uuid
+import zlib
+from itertools import chain
+from itertools import islice
 
 from redis import Redis
+from redis.exceptions import ResponseError
+from redis.exceptions import WatchError
 
+from redis_completion.cache import LRUCache
+from redis_completion.instrumentation import CountingClient
+from redis_completion.instrumentation import Instrumentation
+from redis_completion.instrumentation import TimedTokenizer
+from redis_completion import snapshot
 from redis_completion.stop_words import STOP_WORDS as _STOP_WORDS
+from redis_completion.tokenizer import Tokenizer
 
 
 # aggressive stop words will be better when the length of the document is longer
@@ -15,8 +31,307 @@ AGGRESSIVE_STOP_WORDS = _STOP_WORDS
 # default stop words should work fine for titles and things like that
 DEFAULT_STOP_WORDS = set(['a', 'an', 'of', 'the'])
 
+# transactions watching keys that are written to concurrently are retried at
+# most this many times, as under a steady stream of writes they could otherwise
+# be retried forever
+TRANSACTION_ATTEMPTS = 10
 
-class RedisEngine(object):
+# scores encode the first characters of a title as digits in base 27, where
+# a-z are 2-27 and 1 is used for padding and any other character.  packed
+# scores only use as many digits as fit exactly in the mantissa of a double.
+SCORE_BASE = 27
+PACKED_SCORE_SIZE = 11
+_CHAR_VALUES = dict((c, i + 2) for i, c in enumerate('abcdefghijklmnopqrstuvwxyz'))
+_SCORE_TABLES = {}
+
+
+def _score_tables(max_size, exponent):
+    """
+    Precompute the place values of each character in a score of
+    ``max_size`` digits, along with the contribution of the padding for
+    every possible key length
+    """
+    if (max_size, exponent) not in _SCORE_TABLES:
+        powers = [SCORE_BASE ** (max_size - i - 1 + exponent) for i in range(max_size)]
+        padding = [sum(powers[i:]) for i in range(max_size + 1)]
+        _SCORE_TABLES[max_size, exponent] = (powers, padding)
+    return _SCORE_TABLES[max_size, exponent]
+
+# intersect the prefix sets into the cache key (unless the intersection is
+# already cached), then return a slice of the matching ids' data.  single-word
+# searches read their prefix set directly.  every key is passed in KEYS, with the
+# cache key named by the client, as redis requires of scripts.  missing data is
+# returned as an empty string, as a nil would truncate the lua table.
+SEARCH_SCRIPT = """
+local data_key, key = KEYS[1], KEYS[2]
+if #KEYS > 2 and redis.call('EXISTS', key) == 0 then
+    local args = {unpack(KEYS, 3)}
+    table.insert(args, 'AGGREGATE')
+    table.insert(args, 'MAX')
+    redis.call('ZINTERSTORE', key, #KEYS - 2, unpack(args))
+    redis.call('EXPIRE', key, ARGV[1])
+end
+local obj_ids = redis.call('ZRANGE', key, ARGV[2], ARGV[3])
+if #obj_ids == 0 then
+    return {}
+end
+local data = redis.call('HMGET', data_key, unpack(obj_ids))
+for i = 1, #obj_ids do
+    if not data[i] then
+        data[i] = ''
+    end
+end
+return data
+"""
+
+
+# return the current generation, first bumping it if the index has been written
+# to and it has not been bumped in the last ARGV[1] milliseconds
+GENERATION_SCRIPT = """
+local generation_key, dirty_key, lock_key = KEYS[1], KEYS[2], KEYS[3]
+if redis.call('GET', dirty_key) and
+        redis.call('SET', lock_key, 1, 'NX', 'PX', ARGV[1]) then
+    redis.call('DEL', dirty_key)
+    return tostring(redis.call('INCR', generation_key))
+end
+return redis.call('GET', generation_key)
+"""
+
+
+# add to (or set) the popularity of an object.  hits are worth exponentially
+# more as time passes, which is equivalent to decaying older hits.  before the
+# increments get too large, every popularity is scaled down and the epoch the
+# increments are measured from is moved forward.
+POPULARITY_SCRIPT = """
+local popularity_key, epoch_key = KEYS[1], KEYS[2]
+local now, half_life = tonumber(ARGV[3]), tonumber(ARGV[4])
+local epoch = tonumber(redis.call('GET', epoch_key))
+if not epoch then
+    epoch = now
+    redis.call('SET', epoch_key, epoch)
+end
+local exponent = (now - epoch) / half_life
+if exponent > 64 then
+    redis.call('ZUNIONSTORE', popularity_key, 1, popularity_key, 'WEIGHTS', 2 ^ -exponent)
+    redis.call('SET', epoch_key, now)
+    exponent = 0
+end
+local value = tonumber(ARGV[2]) * 2 ^ exponent
+if ARGV[5] == 'set' then
+    return redis.call('ZADD', popularity_key, value, ARGV[1])
+end
+return redis.call('ZINCRBY', popularity_key, value, ARGV[1])
+"""
+
+
+def _to_bytes(value):
+    if not isinstance(value, (bytes, type(u''))):
+        value = '%s' % value
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _to_text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _unpack_record(record, codec):
+    """
+    Return the title and data encoded in a compact record, decoded if the
+    record was read by a client that decodes responses
+    """
+    if record is None:
+        return None, None
+    decoded = not isinstance(record, bytes)
+    record = _to_bytes(record)
+    if record[:1] == b'z':
+        record = codec.decompress(record[1:])
+    if record[:1] == b'=':
+        title = data = record[1:]
+    else:
+        size, record = record[1:].split(b':', 1)
+        size = int(size)
+        title, data = record[:size], record[size:]
+    if decoded:
+        return title.decode('utf-8'), data.decode('utf-8')
+    return title, data
+
+
+# map external ids to dense integers, assigning new integers from a counter
+INTERN_SCRIPT = """
+local forward_key, reverse_key, counter_key = KEYS[1], KEYS[2], KEYS[3]
+local ids = {}
+for i, obj_id in ipairs(ARGV) do
+    local id = redis.call('HGET', forward_key, obj_id)
+    if not id then
+        id = redis.call('INCR', counter_key)
+        redis.call('HSET', forward_key, obj_id, id)
+        redis.call('HSET', reverse_key, id, obj_id)
+    end
+    ids[i] = tonumber(id)
+end
+return ids
+"""
+
+
+# trim a prefix set to its first ``max_size`` members, remembering that it has
+# been truncated so searches do not rely on it being complete
+TRIM_SCRIPT = """
+local removed = redis.call('ZREMRANGEBYRANK', KEYS[1], ARGV[1], -1)
+if removed > 0 then
+    redis.call('SADD', KEYS[2], KEYS[1])
+end
+return removed
+"""
+
+
+# number a change to the index and announce it to replicas, prefixed by its
+# sequence number, so they can tell when they have missed one
+PUBLISH_SCRIPT = """
+local sequence = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], sequence .. ' ' .. ARGV[2])
+return sequence
+"""
+
+
+def _operation(method):
+    """
+    Run the method against the index an aliased engine currently points at,
+    reporting it to the engine's observer
+    """
+    @functools.wraps(method)
+    def inner(self, *args, **kwargs):
+        engine = self
+        if self.alias_key is not None:
+            engine = self._resolve()
+        if self._instrumentation is None:
+            return method(engine, *args, **kwargs)
+        return self._instrumentation.run(
+            method.__name__, method, engine, *args, **kwargs)
+    return inner
+
+
+class BaseEngine(object):
+    """
+    Tokenizing, scoring and result handling shared by the engines
+    """
+    _instrumentation = None
+
+    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300,
+                 batch_size=1000, packed_scores=False, tokenizer=None):
+        if tokenizer is None:
+            tokenizer = Tokenizer(
+                min_length,
+                (stop_words is None) and DEFAULT_STOP_WORDS or stop_words)
+
+        self.tokenizer = tokenizer
+        self.min_length = tokenizer.min_length
+        self.stop_words = tokenizer.stop_words
+        self.cache_timeout = cache_timeout
+        self.batch_size = batch_size
+        self.packed_scores = packed_scores
+        self._set_prefix(prefix)
+
+    def _set_prefix(self, prefix):
+        self.prefix = prefix
+        self.data_key = '%s:d' % prefix
+        self.title_key = '%s:t' % prefix
+        self.generation_key = '%s:g' % prefix
+        self.search_key = lambda k: '%s:s:%s' % (prefix, k)
+
+        # cached intersections live in their own namespace and include the
+        # generation, so writes make them unreachable
+        self.cache_prefix = '%s:c:' % prefix
+
+    def cache_key(self, generation, cleaned, suffix=''):
+        return '%s%s:%s%s' % (self.cache_prefix, generation or 0, '|'.join(cleaned), suffix)
+
+    def score_key(self, k, max_size=20):
+        if self.packed_scores:
+            max_size = min(max_size, PACKED_SCORE_SIZE)
+            powers, padding = _score_tables(max_size, 0)
+        else:
+            powers, padding = _score_tables(max_size, 1)
+
+        score = padding[min(len(k), max_size)]
+        for c, place in zip(k, powers):
+            score += _CHAR_VALUES.get(c, 1) * place
+        return score
+
+    def clean_phrase(self, phrase):
+        # titles read back from redis are bytes unless the client decodes them
+        return self.tokenizer.tokenize(_to_text(phrase))
+
+    def create_key(self, phrase):
+        return ' '.join(self.clean_phrase(phrase))
+
+    def autocomplete_keys(self, w):
+        return iter(self.tokenizer.prefixes(w))
+
+    def partial_keys(self, title):
+        """
+        The set of prefixes under which an object with the given title is
+        indexed
+        """
+        return self.tokenizer.partial_keys(self.clean_phrase(title))
+
+    def _normalize(self, obj_id, title=None, data=None, boost=None):
+        if title is None:
+            title = obj_id
+        if data is None:
+            data = title
+        return obj_id, title, data, boost
+
+    def _first_batch_size(self, limit, filters):
+        # the first batch is sized to the requested limit, with headroom when
+        # filters may reject rows
+        if limit:
+            return filters and limit * 2 or limit
+        return self.batch_size
+
+    def _next_batch_size(self, batch_size):
+        return min(batch_size * 2, max(self.batch_size, batch_size))
+
+    def _event(self):
+        """
+        Return the event of the operation being performed, if instrumented
+        """
+        if self._instrumentation is not None:
+            return self._instrumentation.current()
+
+    def _results(self, batches, filters=None, mappers=None):
+        event = filters and self._event()
+        if event:
+            event.candidates = event.candidates or 0
+
+        for batch in batches:
+            for raw_data in batch:
+                if not raw_data:
+                    continue
+
+                if mappers:
+                    for m in mappers:
+                        raw_data = m(raw_data)
+
+                if filters:
+                    if event:
+                        event.candidates += 1
+                    passes = True
+                    for f in filters:
+                        if not f(raw_data):
+                            passes = False
+                            break
+
+                    if not passes:
+                        continue
+
+                yield raw_data
+
+
+class RedisEngine(BaseEngine):
     """
     References
     ----------
@@ -25,145 +340,1213 @@ class RedisEngine(object):
     http://stackoverflow.com/questions/1958005/redis-autocomplete/1966188#1966188
     http://patshaughnessy.net/2011/11/29/two-ways-of-using-redis-to-build-a-nosql-autocomplete-search-index
     """
-    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300, **conn_kwargs):
+    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300,
+                 batch_size=1000, scripted_search=False, local_cache_size=0,
+                 packed_scores=False, tokenizer=None, popularity_half_life=None,
+                 max_per_prefix=None, compact_storage=False, storage_buckets=1024,
+                 compress_threshold=None, codec=zlib, intern_ids=False,
+                 coalesce_writes=None, alias=False, alias_refresh=1, observer=None,
+                 publish_changes=False, **conn_kwargs):
+        super(RedisEngine, self).__init__(
+            min_length, prefix, stop_words, cache_timeout, batch_size, packed_scores,
+            tokenizer)
+
         self.conn_kwargs = conn_kwargs
         self.client = self.get_client()
+        self.scripted_search = scripted_search
 
-        self.min_length = min_length
-        self.prefix = prefix
-        self.stop_words = (stop_words is None) and DEFAULT_STOP_WORDS or stop_words
-        self.cache_timeout = cache_timeout
+        # an observer is passed an Event describing every operation
+        if observer is not None:
+            self._instrumentation = Instrumentation(observer)
+            self.client = CountingClient(self.client, self._instrumentation)
+            self.tokenizer = TimedTokenizer(self.tokenizer, self._instrumentation)
+            self.score_key = self._instrumentation.timed('score', self.score_key)
+
+        # when a half-life is given, search results are ranked by popularity
+        self.popularity_half_life = popularity_half_life
+
+        # prefix sets can be capped, either at the same size for every prefix
+        # or per prefix length, e.g. {2: 1000, 3: 5000}
+        self.max_per_prefix = max_per_prefix
+
+        # in compact mode the title and data of an object are stored as a single
+        # record, in one of ``storage_buckets`` small hashes
+        self.compact_storage = compact_storage
+        self.storage_buckets = storage_buckets
+        self.compress_threshold = compress_threshold
+        self.codec = codec
+
+        # ids can be replaced by integers everywhere except in the mappings
+        # between the two
+        self.intern_ids = intern_ids
+
+        # when coalescing, writes only mark the index as changed, and searches
+        # bump the generation at most once every ``coalesce_writes`` seconds
+        self.coalesce_writes = coalesce_writes
+
+        # an aliased engine's prefix names a key holding the prefix the index
+        # is actually stored under, which is looked up every ``alias_refresh``
+        # seconds
+        if alias:
+            self.alias = self.prefix
+            self.alias_key = '%s@alias' % self.prefix
+            self.alias_version_key = '%s@version' % self.prefix
+        else:
+            self.alias = self.alias_key = self.alias_version_key = None
+        self.alias_refresh = alias_refresh
+        self._resolved = (0, None)
+
+        # changes can be published for replicas to apply, numbered using a
+        # counter that lives outside the index, so flushing it or switching
+        # its alias does not reset the numbering
+        self.publish_changes = publish_changes
+        self.changes_channel = '%s@changes' % self.prefix
+        self.sequence_key = '%s@sequence' % self.prefix
 
-        self.data_key = '%s:d' % self.prefix
-        self.title_key = '%s:t' % self.prefix
-        self.search_key = lambda k: '%s:s:%s' % (self.prefix, k)
+        self._search_script = self.client.register_script(SEARCH_SCRIPT)
+        self._generation_script = self.client.register_script(GENERATION_SCRIPT)
+        self._intern_script = self.client.register_script(INTERN_SCRIPT)
+        self._popularity_script = self.client.register_script(POPULARITY_SCRIPT)
+        self._trim_script = self.client.register_script(TRIM_SCRIPT)
+        self._publish_script = self.client.register_script(PUBLISH_SCRIPT)
+        self._use_unlink = True
+
+        # search results can be cached in-process, in which case they are
+        # invalidated whenever the index generation is bumped by a write
+        if local_cache_size:
+            self.local_cache = LRUCache(local_cache_size, cache_timeout)
+        else:
+            self.local_cache = None
+
+    def _set_prefix(self, prefix):
+        super(RedisEngine, self)._set_prefix(prefix)
+        self.popularity_key = '%s:p' % prefix
+        self.popularity_epoch_key = '%s:pe' % prefix
+        self.popularity_generation_key = '%s:pg' % prefix
+        self.truncated_key = '%s:x' % prefix
+        self.intern_counter_key = '%s:i' % prefix
+        self.intern_forward_key = '%s:if' % prefix
+        self.intern_reverse_key = '%s:ir' % prefix
+        self.generation_dirty_key = '%s:gd' % prefix
+        self.generation_lock_key = '%s:gl' % prefix
+
+    def for_prefix(self, prefix):
+        """
+        Return a copy of this engine, sharing its connection and settings,
+        that reads and writes the index stored under ``prefix``
+        """
+        engine = copy.copy(self)
+        engine.alias = engine.alias_key = engine.alias_version_key = None
+        engine._set_prefix(prefix)
+        return engine
+
+    def _resolve(self):
+        expires, engine = self._resolved
+        if engine is None or time.time() >= expires:
+            prefix = self.client.get(self.alias_key) or self.alias
+            if engine is None or engine.prefix != prefix:
+                engine = self.for_prefix(prefix)
+            self._resolved = (time.time() + self.alias_refresh, engine)
+        return engine
 
     def get_client(self):
         return Redis(**self.conn_kwargs)
 
-    def flush(self, everything=False, batch_size=1000):
+    @_operation
+    def flush(self, everything=False, batch_size=1000, rate_limit=None):
+        """
+        Delete the index.  Keys are discovered incrementally using SCAN and
+        removed in batches of ``batch_size`` using UNLINK (or DEL on servers
+        without UNLINK).  ``rate_limit`` optionally caps the number of keys
+        deleted per second, to avoid stalling other users of the server.
+        """
+        generation = self.client.get(self.generation_key)
+
         if everything:
-            return self.client.flushdb()
+            sequence = self.client.get(self.sequence_key)
+            self.client.flushdb()
+            if sequence is not None:
+                self.client.set(self.sequence_key, sequence)
+        else:
+            self._delete_prefix(self.prefix, batch_size, rate_limit)
 
-        # this could be expensive :-(
-        keys = self.client.keys('%s:*' % self.prefix)
+        # the generation must keep increasing, otherwise results cached before
+        # the flush could become valid again
+        self.client.set(self.generation_key, int(generation or 0) + 1)
+        if self.local_cache is not None:
+            self.local_cache.clear()
+        self._publish([('flush',)])
 
-        # batch keys
-        for i in range(0, len(keys), batch_size):
-            self.client.delete(*keys[i:i+batch_size])
+    def _publish(self, changes, pipe=None):
+        """
+        Queue a message describing the given changes for replicas, if changes
+        are published.  Each change is a tuple of the operation (``store``,
+        ``remove``, ``flush`` or ``reload``) and its arguments.
+        """
+        if self.publish_changes and changes:
+            message = json.dumps(changes, default=lambda b: b.decode('utf-8'))
+            self._publish_script(
+                keys=[self.sequence_key], args=[self.changes_channel, message],
+                client=pipe)
 
-    def score_key(self, k, max_size=20):
-        k_len = len(k)
-        a = ord('a') - 2
-        score = 0
-
-        for i in range(max_size):
-            if i < k_len:
-                c = (ord(k[i]) - a)
-                if c < 2 or c > 27:
-                    c = 1
+    def _bump_generation(self, pipe):
+        if self.coalesce_writes:
+            pipe.set(self.generation_dirty_key, 1)
+        else:
+            pipe.incr(self.generation_key)
+
+    @_operation
+    def generation(self):
+        """
+        Return the current generation of the index, which changes whenever the
+        index is written to
+        """
+        if self.coalesce_writes:
+            return self._generation_script(
+                keys=[self.generation_key, self.generation_dirty_key,
+                      self.generation_lock_key],
+                args=[max(1, int(self.coalesce_writes * 1000))])
+        return self.client.get(self.generation_key)
+
+    def _ranking_generation(self, generation):
+        """
+        Ranked results are cached under the popularity generation, bumped by
+        every hit, as well as the generation of the index
+        """
+        popularity = self.client.get(self.popularity_generation_key)
+        return '%s.%s' % (generation or 0, int(popularity or 0))
+
+    def _delete_prefix(self, prefix, batch_size=1000, rate_limit=None):
+        start = time.time()
+        deleted = 0
+        for keys in self._scan_batches(prefix, batch_size):
+            self._unlink(keys)
+            deleted += len(keys)
+            if rate_limit:
+                delay = start + float(deleted) / rate_limit - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        return deleted
+
+    def rebuild(self, objects, chunk_size=1000, transaction=False, background=True,
+                batch_size=1000, rate_limit=None, drop_delay=60):
+        """
+        Build a new copy of an aliased index from an iterable of objects, as
+        taken by :py:meth:`store_many`, under a new prefix, then point the
+        alias at it.  The previous copy is deleted after ``drop_delay``
+        seconds, which must be longer than the ``alias_refresh`` of every
+        engine reading the index, in a background thread unless
+        ``background`` is false.
+        """
+        if self.alias_key is None:
+            raise ValueError('Only an aliased index can be rebuilt')
+
+        version = self.client.incr(self.alias_version_key)
+        shadow = self.for_prefix('%s_v%s' % (self.alias, version))
+        # replicas reload the index once the alias has been switched, rather
+        # than applying the objects to the copy of the previous index
+        shadow.publish_changes = False
+        shadow._delete_prefix(shadow.prefix, batch_size)
+        stats = shadow.store_many(objects, chunk_size, transaction)
+        shadow.publish_changes = self.publish_changes
+
+        previous = self.client.getset(self.alias_key, shadow.prefix) or self.alias
+        self._resolved = (time.time() + self.alias_refresh, shadow)
+        stats['prefix'] = shadow.prefix
+        stats['previous_prefix'] = previous
+        self._publish([('reload',)])
+
+        def drop():
+            time.sleep(max(drop_delay, self.alias_refresh))
+            self._delete_prefix(previous, batch_size, rate_limit)
+
+        if background:
+            thread = threading.Thread(target=drop)
+            thread.daemon = True
+            thread.start()
+            stats['drop_thread'] = thread
+        else:
+            drop()
+        return stats
+
+    @_operation
+    def export_index(self, path, batch_size=1000, compress=True, dump=False):
+        """
+        Write a copy of the index to a snapshot file, which can be loaded
+        using :py:meth:`import_index`.  Keys are discovered using SCAN, and
+        the keys holding up to ``batch_size`` entries are read in pipelines,
+        while larger ones are read ``batch_size`` entries at a time using
+        HSCAN, ZSCAN and SSCAN.  If ``dump`` is set, keys are copied using
+        DUMP instead, which is much faster but can only be restored on the
+        same or a newer version of redis.  Returns a dictionary of statistics.
+        """
+        # cached intersections and the generations are not part of the index
+        skip = set(_to_bytes(k) for k in (
+            self.generation_key, self.generation_dirty_key, self.generation_lock_key,
+            self.popularity_generation_key))
+        cache_prefix = _to_bytes(self.cache_prefix)
+        truncated_key = _to_bytes(self.truncated_key)
+        relative = lambda key: _to_bytes(key)[len(self.prefix) + 1:]
+
+        # the kind of each type of key, the commands reading its size and its
+        # entries, and how to scan it
+        types = {
+            'hash': (snapshot.HASH, 'hlen', lambda p, k: p.hgetall(k),
+                     self.client.hscan_iter),
+            'zset': (snapshot.ZSET, 'zcard', lambda p, k: p.zrange(k, 0, -1, withscores=True),
+                     self.client.zscan_iter),
+            'set': (snapshot.SET, 'scard', lambda p, k: p.smembers(k),
+                    self.client.sscan_iter),
+            'string': (snapshot.STRING, 'strlen', lambda p, k: p.get(k), None),
+        }
+
+        stats = {'keys': 0, 'entries': 0}
+        start = time.time()
+        with open(path, 'wb') as fh:
+            writer = snapshot.SnapshotWriter(fh, compress and self.codec or None)
+            for keys in self._scan_batches(self.prefix, batch_size):
+                keys = [k for k in keys
+                        if _to_bytes(k) not in skip and
+                        not _to_bytes(k).startswith(cache_prefix)]
+                pipe = self.client.pipeline(transaction=False)
+
+                # the truncated set holds the names of prefix sets, which
+                # have to be rewritten when the prefix changes
+                if dump:
+                    dumped = [k for k in keys if _to_bytes(k) != truncated_key]
+                    keys = [k for k in keys if _to_bytes(k) == truncated_key]
+                    for key in dumped:
+                        pipe.dump(key)
+                    for key, payload in zip(dumped, pipe.execute()):
+                        if payload is not None:
+                            writer.write(snapshot.DUMP, relative(key), [payload])
+                            stats['keys'] += 1
+
+                for key in keys:
+                    pipe.type(key)
+                # keys that expired since they were scanned have no type
+                keys = [(key, types[_to_text(key_type)]) for key, key_type in
+                        zip(keys, pipe.execute()) if _to_text(key_type) in types]
+
+                for key, (_, size, _, _) in keys:
+                    getattr(pipe, size)(key)
+                sizes = pipe.execute()
+                small = [(key, read) for (key, (_, _, read, scan)), ct in zip(keys, sizes)
+                         if ct <= batch_size or scan is None]
+                for key, read in small:
+                    read(pipe, key)
+                contents = dict(zip([key for key, _ in small], pipe.execute()))
+
+                for key, (kind, _, _, scan) in keys:
+                    if key in contents:
+                        entries = contents[key]
+                        if kind == snapshot.HASH:
+                            entries = entries.items()
+                        elif kind == snapshot.STRING:
+                            entries = entries is not None and [entries] or []
+                    else:
+                        entries = scan(key, count=batch_size)
+                    if _to_bytes(key) == truncated_key:
+                        entries = [relative(k) for k in entries]
+                    stats['entries'] += writer.write(kind, relative(key), entries, batch_size)
+                    stats['keys'] += 1
+
+        stats['bytes'] = writer.bytes
+        stats['elapsed'] = time.time() - start
+        return stats
+
+    @_operation
+    def import_index(self, path, chunk_size=1000):
+        """
+        Load a snapshot written by :py:meth:`export_index` into this engine's
+        prefix, which may differ from the prefix it was exported from.  The
+        entries are sent to redis in pipelines of roughly ``chunk_size``
+        entries, a block of the file at a time.  Returns a dictionary of
+        statistics.
+        """
+        prefix = _to_bytes(self.prefix) + b':'
+        commands = {snapshot.HASH: 'HMSET', snapshot.ZSET: 'ZADD',
+                    snapshot.SET: 'SADD', snapshot.STRING: 'SET',
+                    snapshot.DUMP: 'RESTORE'}
+
+        pipe = self.client.pipeline(transaction=False)
+        stats = {'keys': 0, 'entries': 0}
+        pending = 0
+        previous = None
+        start = time.time()
+        for kind, key, entries in snapshot.read_snapshot(path, self.codec):
+            # the blocks of a key are written one after the other
+            stats['keys'] += key != previous
+            previous = key
+            if not entries:
+                continue
+            key = prefix + key
+            if kind == snapshot.HASH:
+                args = [v for entry in entries for v in entry]
+            elif kind == snapshot.ZSET:
+                args = [v for member, score in entries for v in (repr(score), member)]
+            elif kind == snapshot.DUMP:
+                args = [0, entries[0], 'REPLACE']
+            elif key == _to_bytes(self.truncated_key):
+                args = [prefix + k for k in entries]
             else:
-                c = 1
-            score += c*(27**(max_size-i))
-        return score
+                args = entries
+            pipe.execute_command(commands[kind], key, *args)
+            stats['entries'] += len(entries)
+            pending += len(entries)
+            if pending >= chunk_size:
+                pipe.execute()
+                pending = 0
 
-    def clean_phrase(self, phrase):
-        phrase = re.sub('[^a-z0-9_\-\s]', '', phrase.lower())
-        return [w for w in phrase.split() if w not in self.stop_words]
+        self._bump_generation(pipe)
+        pipe.execute()
+        self._publish([('reload',)])
 
-    def create_key(self, phrase):
-        return ' '.join(self.clean_phrase(phrase))
+        stats['elapsed'] = time.time() - start
+        return stats
 
-    def autocomplete_keys(self, w):
-        ml = self.min_length
-        for i, char in enumerate(w[ml:]):
-            yield w[:i+ml]
-        yield w
+    def _scan_batches(self, prefix, batch_size):
+        # escape any glob characters that appear in the prefix
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', prefix) + ':*'
+        batch = []
+        for key in self.client.scan_iter(pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
-    def store(self, obj_id, title=None, data=None):
-        pipe = self.client.pipeline()
+    def _transaction(self, func, keys):
+        """
+        Like the client's ``transaction``, call ``func`` with a pipeline
+        watching ``keys`` and execute the commands it queues, retrying while
+        the keys are modified, but at most ``TRANSACTION_ATTEMPTS`` times
+        """
+        with self.client.pipeline() as pipe:
+            for attempt in range(TRANSACTION_ATTEMPTS):
+                try:
+                    pipe.watch(*keys)
+                    func(pipe)
+                    return pipe.execute()
+                except WatchError:
+                    pipe.reset()
+        raise WatchError('Watched keys changed %d times in a row' % TRANSACTION_ATTEMPTS)
 
-        if title is None:
-            title = obj_id
-        if data is None:
-            data = title
+    def _unlink(self, keys):
+        if self._use_unlink:
+            try:
+                return self.client.execute_command('UNLINK', *keys)
+            except ResponseError:
+                # UNLINK is only available in redis 4.0 and newer
+                self._use_unlink = False
+        return self.client.delete(*keys)
+
+    def _store_commands(self, pipe, obj_id, title, data, words, boost=None,
+                        previous=None):
+        """
+        Queue the commands needed to index a single object, given the words
+        of its title, returning the number of commands added to the pipeline.
+        If the words of the title the object was previously stored with are
+        given, only the prefix sets that change are written to.
+        """
+        title_score = self.score_key(' '.join(words))
+        partial_keys = self._indexed_keys(words)
+
+        ct = self._write_record(pipe, obj_id, title, data)
+
+        if boost is not None:
+            self._update_popularity(obj_id, boost, 'set', pipe)
+            ct += 1
+
+        if previous is not None:
+            previous_keys = self._indexed_keys(previous)
+            for partial_key in previous_keys - partial_keys:
+                pipe.zrem(self.search_key(partial_key), obj_id)
+                ct += 1
+            # the score only needs updating if the title's score changed
+            if self.score_key(' '.join(previous)) == title_score:
+                partial_keys = partial_keys - previous_keys
+
+        for partial_key in partial_keys:
+            key = self.search_key(partial_key)
+            pipe.zadd(key, {obj_id: title_score})
+            ct += 1
+
+            max_size = self.prefix_limit(partial_key)
+            if max_size is not None:
+                self._trim_script(
+                    keys=[key, self.truncated_key], args=[max_size], client=pipe)
+                ct += 1
+
+        return ct
+
+    def _intern(self, obj_ids):
+        """
+        Return the integer ids of the given objects, assigning new ones to
+        objects that do not have one yet
+        """
+        return self._intern_script(
+            keys=[self.intern_forward_key, self.intern_reverse_key,
+                  self.intern_counter_key],
+            args=obj_ids)
+
+    def _internal_ids(self, obj_ids):
+        if not self.intern_ids:
+            return obj_ids
+        return self.client.hmget(self.intern_forward_key, obj_ids)
+
+    def _external_ids(self, obj_ids):
+        if not self.intern_ids or not obj_ids:
+            return obj_ids
+        return self.client.hmget(self.intern_reverse_key, obj_ids)
+
+    def _record_key(self, obj_id):
+        bucket = (zlib.crc32(_to_bytes(obj_id)) & 0xffffffff) % self.storage_buckets
+        return '%s:r:%s' % (self.prefix, bucket)
 
-        title_score = self.score_key(self.create_key(title))
+    def _record_keys(self, obj_ids):
+        if not self.compact_storage:
+            return [self.title_key]
+        return sorted(set(self._record_key(obj_id) for obj_id in obj_ids))
 
+    def _encode_record(self, title, data):
+        """
+        Encode a title and its data as a single string.  Data that is the same
+        as the title is not stored twice, and large records are compressed
+        when that makes them smaller.
+        """
+        title, data = _to_bytes(title), _to_bytes(data)
+        if data == title:
+            record = b'=' + title
+        else:
+            record = b'+' + str(len(title)).encode('ascii') + b':' + title + data
+
+        if self.compress_threshold is not None and len(record) > self.compress_threshold:
+            compressed = self.codec.compress(record)
+            if len(compressed) + 1 < len(record):
+                record = b'z' + compressed
+        return record
+
+    def _decode_record(self, record):
+        return _unpack_record(record, self.codec)
+
+    def _write_record(self, pipe, obj_id, title, data):
+        if self.compact_storage:
+            pipe.hset(self._record_key(obj_id), obj_id, self._encode_record(title, data))
+            return 1
         pipe.hset(self.data_key, obj_id, data)
         pipe.hset(self.title_key, obj_id, title)
+        return 2
+
+    def _delete_record(self, pipe, obj_id):
+        if self.compact_storage:
+            pipe.hdel(self._record_key(obj_id), obj_id)
+        else:
+            pipe.hdel(self.data_key, obj_id)
+            pipe.hdel(self.title_key, obj_id)
+
+    def _get_payloads(self, obj_ids, title_ids=(), data=True):
+        """
+        Fetch the data of ``obj_ids`` (unless ``data`` is false) and the titles
+        of ``title_ids``, returning a list of data and a dictionary of titles
+        """
+        pipe = self.client.pipeline(transaction=False)
+        if self.compact_storage:
+            ids = data and obj_ids or title_ids
+            for obj_id in ids:
+                pipe.hget(self._record_key(obj_id), obj_id)
+            records = [self._decode_record(r) for r in pipe.execute()]
+
+            title_ids = set(title_ids)
+            titles = dict((obj_id, title) for obj_id, (title, _) in zip(ids, records)
+                          if obj_id in title_ids)
+            return data and [d for _, d in records] or None, titles
+
+        if data:
+            pipe.hmget(self.data_key, obj_ids)
+        if title_ids:
+            pipe.hmget(self.title_key, title_ids)
+        results = pipe.execute()
+        titles = dict(zip(title_ids, title_ids and results[-1] or ()))
+        return data and results[0] or None, titles
+
+    def _iter_titles(self, batch_size=1000):
+        """
+        Iterate over the ``(obj_id, title)`` of every object in the index
+        """
+        batch = []
+        for item in self._scan_titles(batch_size):
+            batch.append(item)
+            if len(batch) == batch_size:
+                for item in self._translate_titles(batch):
+                    yield item
+                batch = []
+        for item in self._translate_titles(batch):
+            yield item
+
+    def _scan_titles(self, batch_size):
+        if not self.compact_storage:
+            for item in self.client.hscan_iter(self.title_key, count=batch_size):
+                yield item
+            return
+
+        for bucket in range(self.storage_buckets):
+            key = '%s:r:%s' % (self.prefix, bucket)
+            for obj_id, record in self.client.hscan_iter(key, count=batch_size):
+                yield obj_id, self._decode_record(record)[0]
+
+    def _translate_titles(self, batch):
+        obj_ids = self._external_ids([obj_id for obj_id, _ in batch])
+        return [(obj_id, title) for obj_id, (_, title) in zip(obj_ids, batch)]
+
+    def _fetch_data(self, obj_ids):
+        """
+        Fetch the data stored for the given objects
+        """
+        internal_ids = self._internal_ids(obj_ids)
+        found = [obj_id for obj_id in internal_ids if obj_id is not None]
+        data = dict(zip(found, found and self._get_payloads(found)[0] or ()))
+        return [data.get(obj_id) for obj_id in internal_ids]
+
+    def _indexed_keys(self, words):
+        """
+        The prefixes the given words are indexed under.  When a word's own
+        prefix set can be truncated, the word is also indexed under itself
+        followed by a '#', which cannot appear in a word, in a set that is
+        never truncated, so expanding a truncated set finds every object.
+        """
+        partial_keys = self.tokenizer.partial_keys(words)
+        if self.max_per_prefix:
+            partial_keys.update(
+                w + '#' for w in words if self.prefix_limit(w) is not None)
+        return partial_keys
+
+    def prefix_limit(self, partial_key):
+        """
+        Return the maximum number of objects stored for the given prefix, or
+        ``None`` if its set is unbounded
+        """
+        if partial_key.endswith('#'):
+            return None
+        if isinstance(self.max_per_prefix, dict):
+            return self.max_per_prefix.get(len(partial_key))
+        return self.max_per_prefix
+
+    @_operation
+    def store(self, obj_id, title=None, data=None, boost=None):
+        pipe = self.client.pipeline()
 
-        for word in self.clean_phrase(title):
-            for partial_key in self.autocomplete_keys(word):
-                pipe.zadd(self.search_key(partial_key), obj_id, title_score)
+        obj_id, title, data, boost = self._normalize(obj_id, title, data, boost)
+        self._publish([('store', obj_id, title, data)], pipe)
+        if self.intern_ids:
+            obj_id = self._intern([obj_id])[0]
+        self._store_commands(pipe, obj_id, title, data, self.clean_phrase(title), boost)
+        self._bump_generation(pipe)
 
         pipe.execute()
 
-    def store_json(self, obj_id, title, data_dict):
-        return self.store(obj_id, title, json.dumps(data_dict))
+    @_operation
+    def store_json(self, obj_id, title, data_dict, boost=None):
+        return self.store(obj_id, title, json.dumps(data_dict), boost)
+
+    @_operation
+    def update(self, obj_id, title=None, data=None, boost=None):
+        """
+        Store an object, removing it from the prefix sets of the title it was
+        previously stored with that do not apply to its new title.  Only the
+        prefix sets that change are written to.
+        """
+        obj_id, title, data, boost = self._normalize(obj_id, title, data, boost)
+        change = ('store', obj_id, title, data)
+        if self.intern_ids:
+            obj_id = self._intern([obj_id])[0]
+        words = self.clean_phrase(title)
+
+        def update(pipe):
+            # the record is watched, so the title can be read over another
+            # connection
+            previous = self._get_payloads([obj_id], [obj_id], data=False)[1][obj_id]
+            if previous is not None:
+                previous = self.clean_phrase(previous)
+            pipe.multi()
+            self._store_commands(pipe, obj_id, title, data, words, boost, previous)
+            self._bump_generation(pipe)
+            self._publish([change], pipe)
+
+        self._transaction(update, self._record_keys([obj_id]))
+
+    @_operation
+    def update_json(self, obj_id, title, data_dict, boost=None):
+        return self.update(obj_id, title, json.dumps(data_dict), boost)
+
+    @_operation
+    def store_many(self, objects, chunk_size=1000, transaction=True):
+        """
+        Store an iterable of ``(obj_id[, title[, data[, boost]]])`` tuples, sending the
+        commands to redis in pipelines of roughly ``chunk_size`` commands.
+        Returns a dictionary of throughput statistics.
+        """
+        pipe = self.client.pipeline(transaction=transaction)
+        stats = {'objects': 0, 'commands': 0, 'flushes': 0}
+        pending = 0
+        changes = []
+        start = time.time()
+
+        objects = iter(objects)
+        while True:
+            batch = [self._normalize(*obj) for obj in islice(objects, self.batch_size)]
+            if not batch:
+                break
+            external = [obj[0] for obj in batch]
+            if self.intern_ids:
+                obj_ids = self._intern(external)
+                batch = [(i,) + obj[1:] for i, obj in zip(obj_ids, batch)]
+
+            words = self.tokenizer.tokenize_many([obj[1] for obj in batch])
+            for (obj_id, title, data, boost), title_words, external_id in zip(
+                    batch, words, external):
+                pending += self._store_commands(
+                    pipe, obj_id, title, data, title_words, boost)
+                if self.publish_changes:
+                    changes.append(('store', external_id, title, data))
+                stats['objects'] += 1
+
+                if pending >= chunk_size:
+                    self._bump_generation(pipe)
+                    self._publish(changes, pipe)
+                    pipe.execute()
+                    stats['commands'] += pending + 1 + bool(changes)
+                    stats['flushes'] += 1
+                    pending = 0
+                    changes = []
+
+        if pending:
+            self._bump_generation(pipe)
+            self._publish(changes, pipe)
+            pending += 1 + bool(changes)
+            pipe.execute()
+            stats['commands'] += pending
+            stats['flushes'] += 1
+
+        elapsed = time.time() - start
+        stats['elapsed'] = elapsed
+        stats['objects_per_sec'] = elapsed and stats['objects'] / elapsed or 0.
+        stats['commands_per_flush'] = (
+            stats['flushes'] and float(stats['commands']) / stats['flushes'] or 0.)
+        return stats
+
+    @_operation
+    def store_json_many(self, objects, chunk_size=1000, transaction=True):
+        return self.store_many(
+            ((obj[0], obj[1], json.dumps(obj[2])) + tuple(obj[3:])
+             for obj in objects),
+            chunk_size,
+            transaction)
+
+    def _update_popularity(self, obj_id, amount, mode, client=None):
+        return self._popularity_script(
+            keys=[self.popularity_key, self.popularity_epoch_key],
+            args=[obj_id, amount, time.time(),
+                  self.popularity_half_life or 86400, mode],
+            client=client)
 
+    @_operation
+    def record_hit(self, obj_id, weight=1):
+        """
+        Increase the popularity of the given object.  The hits recorded for
+        an object decay exponentially, losing half their weight every
+        ``popularity_half_life`` seconds.  Only the popularity generation is
+        bumped, so results are ranked again while the cached intersections
+        they are ranked from are kept.
+        """
+        obj_id = self._internal_ids([obj_id])[0]
+        if obj_id is not None:
+            pipe = self.client.pipeline()
+            self._update_popularity(obj_id, weight, 'incr', pipe)
+            pipe.incr(self.popularity_generation_key)
+            return pipe.execute()[0]
+
+    def _remove_commands(self, pipe, obj_id, title):
+        # redis deletes sorted sets automatically once they become empty
+        for partial_key in self._indexed_keys(self.clean_phrase(title or '')):
+            pipe.zrem(self.search_key(partial_key), obj_id)
+
+        # finally, remove the title and data
+        self._delete_record(pipe, obj_id)
+        pipe.zrem(self.popularity_key, obj_id)
+
+    @_operation
     def remove(self, obj_id):
-        obj_id = str(obj_id)
-        title = self.client.hget(self.title_key, obj_id) or ''
-        keys = []
-
-        for word in self.clean_phrase(title):
-            for partial_key in self.autocomplete_keys(word):
-                key = self.search_key(partial_key)
-                if not self.client.zrange(key, 1, 2):
-                    self.client.delete(key)
-                else:
-                    self.client.zrem(key, obj_id)
+        self.remove_many([obj_id])
+
+    @_operation
+    def remove_many(self, obj_ids, chunk_size=1000):
+        """
+        Remove the given objects from the index.  The titles are read and the
+        objects removed from every prefix set in a single transaction, which
+        is retried if an object is stored or removed concurrently, raising a
+        ``WatchError`` if that keeps happening.
+        """
+        obj_ids = [str(obj_id) for obj_id in obj_ids]
 
-        # finally, remove the data from the data key
-        self.client.hdel(self.data_key, obj_id)
-        self.client.hdel(self.title_key, obj_id)
+        for i in range(0, len(obj_ids), chunk_size):
+            external = obj_ids[i:i + chunk_size]
+            if self.intern_ids:
+                mapped = [(obj_id, internal_id) for obj_id, internal_id in
+                          zip(external, self._internal_ids(external))
+                          if internal_id is not None]
+                if not mapped:
+                    continue
+                external = [obj_id for obj_id, _ in mapped]
+                chunk = [internal_id for _, internal_id in mapped]
+            else:
+                chunk = external
+
+            def remove(pipe):
+                # the keys are watched, so the titles can be read over
+                # another connection
+                titles = self._get_payloads(chunk, chunk, data=False)[1]
+                pipe.multi()
+                for obj_id in chunk:
+                    self._remove_commands(pipe, obj_id, titles[obj_id])
+                if self.intern_ids:
+                    pipe.hdel(self.intern_forward_key, *external)
+                    pipe.hdel(self.intern_reverse_key, *chunk)
+                self._bump_generation(pipe)
+                self._publish([('remove', obj_id) for obj_id in external], pipe)
 
-    def search(self, phrase, limit=None, filters=None, mappers=None):
+            self._transaction(remove, self._record_keys(chunk))
+
+    @_operation
+    def search(self, phrase, limit=None, filters=None, mappers=None, offset=0):
         """
         Wrap our search & results with prefixing
         """
         cleaned = self.clean_phrase(phrase)
+        batch_size = self._first_batch_size(limit, filters)
+
+        # unfiltered results can be served from the local cache, as long as
+        # the index has not been written to since they were cached.  mappers
+        # are applied to the cached raw data.
+        if self.local_cache is not None and not filters and cleaned:
+            cache_key = (self.prefix, '|'.join(cleaned), limit, offset)
+            generation = self.generation()
+            if self.popularity_half_life:
+                generation = self._ranking_generation(generation)
+            data = self.local_cache.get(cache_key, generation)
+            event = self._event()
+            if event:
+                event.local_cache = data is None and 'miss' or 'hit'
+            if data is None:
+                batches = self._search_batches(cleaned, offset, batch_size)
+                data = list(islice(self._results(batches), limit or None))
+                self.local_cache.set(cache_key, data, generation)
+            return list(self._results([data], mappers=mappers))
+
+        batches = self._search_batches(cleaned, offset, batch_size)
+        return list(islice(self._results(batches, filters, mappers), limit or None))
+
+    @_operation
+    def search_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
+        """
+        Run several searches at once, returning a list of results for each
+        phrase.  The prefix sets for every search are intersected together and
+        the data for the first window of each search is fetched in one batch.
+        """
+        cleaned = [self.clean_phrase(phrase) for phrase in phrases]
+        queries = dict(('|'.join(words), words) for words in cleaned if words)
+        names = list(queries)
+        keys = dict(zip(names, self._intersect_many([queries[n] for n in names])))
+        batch_size = self._first_batch_size(limit, filters)
+
+        # single words whose prefix set is truncated are read on their own
+        truncated = set()
+        if self.max_per_prefix and not self.popularity_half_life:
+            single = [n for n in names if len(queries[n]) == 1]
+            pipe = self.client.pipeline(transaction=False)
+            for n in single:
+                pipe.sismember(self.truncated_key, keys[n])
+            truncated = set(n for n, t in zip(single, pipe.execute()) if t)
+
+        # packed scores need their ties broken, which is done search by search
+        pipe = self.client.pipeline(transaction=False)
+        windowed = [n for n in names if keys[n] is not None and n not in truncated and
+                    not (self.packed_scores and not self.popularity_half_life)]
+        for n in windowed:
+            pipe.zrange(keys[n], offset, offset + batch_size - 1)
+        windows = dict(zip(windowed, pipe.execute()))
+
+        obj_ids = list(set(o for window in windows.values() for o in window))
+        data = dict(zip(obj_ids, obj_ids and self._get_payloads(obj_ids)[0] or ()))
+
+        results = {}
+        for n in names:
+            if keys[n] is None:
+                batches = []
+            elif n in truncated:
+                batches = self._truncated_batches(queries[n][0], offset, batch_size)
+            elif n in windows:
+                batches = [[data[o] for o in windows[n]]]
+                if len(windows[n]) == batch_size:
+                    batches = chain(batches, self._payload_batches(
+                        keys[n], offset + batch_size, self._next_batch_size(batch_size)))
+            else:
+                batches = self._payload_batches(keys[n], offset, batch_size)
+            results[n] = list(islice(self._results(batches, filters, mappers), limit or None))
+
+        return [list(results.get('|'.join(words), ())) for words in cleaned]
+
+    @_operation
+    def search_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        """
+        Lazily generate search results, paging through the matching ids in
+        windows of ``batch_size`` as the results are consumed
+        """
+        batches = self._search_batches(
+            self.clean_phrase(phrase), offset, batch_size or self.batch_size)
+        return self._results(batches, filters, mappers)
+
+    def _search_batches(self, cleaned, offset, batch_size, withscores=False):
         if not cleaned:
-            return []
+            return
 
-        new_key = self.search_key('|'.join(cleaned))
-        if not self.client.exists(new_key):
-            self.client.zinterstore(new_key, map(self.search_key, cleaned))
-            self.client.expire(new_key, self.cache_timeout)
+        # the scripted search does not break ties between packed scores, rank
+        # by popularity, work around truncated prefix sets, read compact
+        # records or coalesce generations
+        if (self.scripted_search and not withscores and not self.packed_scores and
+                not self.popularity_half_life and not self.max_per_prefix and
+                not self.compact_storage and not self.coalesce_writes):
+            result = self._scripted_batch(cleaned, offset, batch_size)
+            if result is not None:
+                new_key, data = result
+                yield data
+                if len(data) < batch_size:
+                    return
+                offset += batch_size
+                batch_size = self._next_batch_size(batch_size)
+                for batch in self._payload_batches(new_key, offset, batch_size):
+                    yield batch
+                return
 
-        ct = 0
-        data = []
+        if (len(cleaned) == 1 and self.max_per_prefix and not self.popularity_half_life
+                and self.client.sismember(self.truncated_key, self.search_key(cleaned[0]))):
+            batches = self._truncated_batches(cleaned[0], offset, batch_size, withscores)
+        else:
+            new_key = self._intersect(cleaned)
+            if new_key is None:
+                return
+            batches = self._payload_batches(new_key, offset, batch_size, withscores)
+        for batch in batches:
+            yield batch
 
-        # grab the data for each object
-        for obj_id in self.client.zrange(new_key, 0, -1):
-            raw_data = self.client.hget(self.data_key, obj_id)
-            if not raw_data:
-                continue
+    def _intersect(self, cleaned):
+        """
+        Intersect the prefix sets for the given words, returning the key of
+        the (possibly cached) result, or ``None`` if there are no results
+        """
+        return self._intersect_many([cleaned])[0]
 
-            if mappers:
-                for m in mappers:
-                    raw_data = m(raw_data)
+    def _intersect_many(self, queries):
+        """
+        Intersect the prefix sets for each of the given lists of words, with
+        the commands for every list sent in the same pipelines
+        """
+        result_keys = [None] * len(queries)
+        pending = []
+        for i, cleaned in enumerate(queries):
+            # ranked results are ranked in full, so a single word whose prefix
+            # set may be truncated is looked up like several
+            if len(cleaned) == 1 and not (self.popularity_half_life and self.max_per_prefix):
+                result_keys[i] = self.search_key(cleaned[0])
+            else:
+                pending.append(i)
+        if not pending and not self.popularity_half_life:
+            return result_keys
 
-            if filters:
-                passes = True
-                for f in filters:
-                    if not f(raw_data):
-                        passes = False
-                        break
+        generation = self.generation()
+        plans = []
+        for i in pending:
+            cleaned = queries[i]
+            new_key = self.cache_key(generation, cleaned)
+            keys = [self.search_key(w) for w in cleaned]
+            plans.append((i, cleaned, new_key, keys))
 
-                if not passes:
-                    continue
+        # a missing prefix set means there are no results.  otherwise the
+        # intersection is left to ZINTERSTORE, which already walks the smallest
+        # set and probes the others, and is faster at it than doing the same
+        # from the client (see the ``planner`` results of benchmark.py).
+        pipe = self.client.pipeline(transaction=False)
+        for i, cleaned, new_key, keys in plans:
+            pipe.exists(new_key)
+            for name in keys:
+                pipe.zcard(name)
+            if self.max_per_prefix:
+                for w in cleaned:
+                    pipe.sismember(self.truncated_key, self.search_key(w))
+        results = iter(pipe.execute())
 
-            data.append(raw_data)
-            ct += 1
-            if limit and ct == limit:
+        event = self._event()
+        missing = []
+        truncated = set()
+        for i, cleaned, new_key, keys in plans:
+            exists = next(results)
+            if event:
+                event.cache_hits += exists and 1 or 0
+                event.cache_misses += (not exists) and 1 or 0
+            sizes = [next(results) for name in keys]
+            if self.max_per_prefix:
+                truncated.update(w for w in cleaned if next(results))
+
+            if exists:
+                result_keys[i] = new_key
+            elif all(sizes):
+                missing.append((i, new_key, keys))
+
+        # truncated prefix sets may be missing matches, so they are replaced by
+        # the sets of the longer prefixes they were truncated from
+        expanded = {}
+        if missing and truncated:
+            expanded = self._expand_many(truncated, generation)
+
+        # an object has the same score in every prefix set, so taking the
+        # maximum keeps packed scores exact
+        pipe = self.client.pipeline(transaction=False)
+        for i, new_key, keys in missing:
+            keys = [expanded.get(k, k) for k in keys]
+            if len(keys) == 1:
+                result_keys[i] = keys[0]
+            else:
+                pipe.zinterstore(new_key, keys, aggregate='MAX')
+                pipe.expire(new_key, self.cache_timeout)
+                result_keys[i] = new_key
+        pipe.execute()
+
+        if self.popularity_half_life:
+            return self._rank_many(queries, result_keys, generation)
+        return result_keys
+
+    def _expand_many(self, words, generation):
+        """
+        Build, for each of the given words, the set of every object with a
+        word starting with it, returning a mapping of the word's prefix set to
+        the key of the (possibly cached) result.  The set is the union of the
+        objects stored under the word itself and under each prefix one
+        character longer, whose sets are expanded in turn while truncated.
+        """
+        words = list(words)
+        expanded = dict((self.search_key(w), self.cache_key(generation, [w]))
+                        for w in words)
+
+        pipe = self.client.pipeline(transaction=False)
+        for w in words:
+            pipe.exists(expanded[self.search_key(w)])
+        pending = [(w, w) for w, exists in zip(words, pipe.execute()) if not exists]
+
+        sources = dict((w, []) for w, _ in pending)
+        while pending:
+            pipe = self.client.pipeline(transaction=False)
+            children = []
+            for w, prefix in pending:
+                sources[w].append(self.search_key(prefix + '#'))
+                for c in self.tokenizer.characters:
+                    children.append((w, prefix + c))
+                    pipe.sismember(self.truncated_key, self.search_key(prefix + c))
+
+            pending = []
+            for (w, prefix), truncated in zip(children, pipe.execute()):
+                if truncated:
+                    pending.append((w, prefix))
+                else:
+                    sources[w].append(self.search_key(prefix))
+
+        pipe = self.client.pipeline(transaction=False)
+        for w, keys in sources.items():
+            new_key = expanded[self.search_key(w)]
+            pipe.zunionstore(new_key, keys, aggregate='MAX')
+            pipe.expire(new_key, self.cache_timeout)
+        pipe.execute()
+        return expanded
+
+    def _truncated_batches(self, word, offset, batch_size, withscores=False):
+        """
+        Page through the results of a search for a single word whose prefix
+        set is truncated.  The set holds the best scoring objects, so it is
+        read up to the score of its last object, which may be shared with
+        objects that were trimmed, and the rest of the results are read from
+        the expanded set, which is only built if they are needed.
+        """
+        key = self.search_key(word)
+        last = self.client.zrange(key, -1, -1, withscores=True)
+        complete = last and self.client.zcount(key, '-inf', '(%r' % last[0][1]) or 0
+
+        if offset < complete:
+            for batch in self._payload_batches(key, offset, batch_size, withscores):
+                batch = batch[:complete - offset]
+                offset += len(batch)
+                yield batch
+                if offset >= complete:
+                    break
+                batch_size = self._next_batch_size(batch_size)
+
+        expanded = self._expand_many([word], self.generation())[key]
+        for batch in self._payload_batches(expanded, offset, batch_size, withscores):
+            yield batch
+
+    def _rank_many(self, queries, result_keys, generation):
+        """
+        Order the results of each search by popularity, most popular first,
+        followed by the objects without any in title order.  Popularities are
+        negated, so they sort before every title score, and the ranked result
+        is the union of the results and their negated popularities, keeping
+        the lowest score of each object.  The '#' cannot appear in a word, so
+        these keys do not clash with cached intersections.
+        """
+        ranking = self._ranking_generation(generation)
+        ranked_keys = [key and self.cache_key(ranking, cleaned, '#p')
+                       for cleaned, key in zip(queries, result_keys)]
+
+        pipe = self.client.pipeline(transaction=False)
+        for ranked_key in filter(None, ranked_keys):
+            pipe.exists(ranked_key)
+        exists = iter(pipe.execute())
+
+        # objects stored before ranking was enabled have no popularity, and
+        # are ranked like those that have never been hit
+        pipe = self.client.pipeline()
+        for key, ranked_key in zip(result_keys, ranked_keys):
+            if ranked_key and not next(exists):
+                popular_key = '%s:%s' % (ranked_key, uuid.uuid4().hex)
+                pipe.zinterstore(popular_key, {key: 0, self.popularity_key: -1})
+                pipe.zremrangebyscore(popular_key, 0, '+inf')
+                pipe.zunionstore(ranked_key, [key, popular_key], aggregate='MIN')
+                pipe.expire(ranked_key, self.cache_timeout)
+                pipe.delete(popular_key)
+        pipe.execute()
+        return ranked_keys
+
+    def _scripted_batch(self, cleaned, offset, batch_size):
+        """
+        Run the intersection and fetch the first batch of data in a single
+        call to the server, after reading the generation the intersection is
+        cached under, returning the key of the intersection and the data, or
+        ``None`` if scripting is unavailable.
+        """
+        if len(cleaned) == 1:
+            keys = [self.data_key, self.search_key(cleaned[0])]
+        else:
+            keys = [self.data_key, self.cache_key(self.generation(), cleaned)]
+            keys.extend(self.search_key(w) for w in cleaned)
+        try:
+            return keys[1], self._search_script(
+                keys=keys, args=[self.cache_timeout, offset, offset + batch_size - 1])
+        except ResponseError:
+            self.scripted_search = False
+
+    def _payload_batches(self, key, start, batch_size, withscores=False):
+        """
+        Page through the ids stored in the sorted set at ``key``, fetching
+        the data for each window using HMGET.  Windows grow until they reach
+        ``batch_size`` and are requested lazily, so nothing past the limit the
+        caller is interested in is transferred.  If ``withscores`` is set,
+        each batch is a list of ``(sort_key, data)`` tuples.
+        """
+        # hits are weighted by the time they were recorded, so popularities
+        # are as good as never tied
+        break_ties = self.packed_scores and not self.popularity_half_life
+
+        while True:
+            obj_ids = self.client.zrange(
+                key, start, start + batch_size - 1,
+                withscores=withscores or break_ties)
+            if not obj_ids:
                 break
 
-        return data
+            fetched = len(obj_ids)
+            if break_ties:
+                batch = self._break_ties(
+                    key, start, obj_ids, fetched == batch_size, withscores)
+            else:
+                data = self._get_payloads([o for o, _ in obj_ids]
+                                          if withscores else obj_ids)[0]
+                if withscores:
+                    batch = [((score, obj_id), raw_data)
+                             for (obj_id, score), raw_data in zip(obj_ids, data)]
+                else:
+                    batch = data
+            yield batch
 
-    def search_json(self, phrase, limit=None, filters=None, mappers=None):
+            if fetched < batch_size:
+                break
+
+            start += len(batch)
+            batch_size = self._next_batch_size(batch_size)
+
+    def _break_ties(self, key, start, obj_ids, extend, withscores):
+        """
+        Packed scores only take the first few characters of a title into
+        account, so objects with equal scores are ordered by their title.
+        The window is extended to include every object sharing the score of
+        the last object, so that ties never straddle two windows.  A window
+        starting part way through a tie is extended back to the start of the
+        tie, and once sorted, the objects ranked before ``start`` are dropped.
+        """
+        # equal scores are ordered by member, which is also what the window
+        # was sliced by
+        skip = 0
+        if start:
+            first_score = obj_ids[0][1]
+            tie_start = self.client.zcount(key, '-inf', '(%r' % first_score)
+            if tie_start < start:
+                obj_ids = self.client.zrange(
+                    key, tie_start, start - 1, withscores=True) + obj_ids
+                skip = start - tie_start
+
+        if extend:
+            last_id, last_score = obj_ids[-1]
+            tied = self.client.zrangebyscore(key, last_score, last_score, withscores=True)
+            obj_ids = obj_ids + [(o, sc) for o, sc in tied if o > last_id]
+
+        counts = {}
+        for obj_id, score in obj_ids:
+            counts[score] = counts.get(score, 0) + 1
+
+        ids = [obj_id for obj_id, _ in obj_ids]
+        if withscores:
+            need_titles = ids
+        else:
+            need_titles = [o for o, score in obj_ids if counts[score] > 1]
+
+        data, titles = self._get_payloads(ids, need_titles)
+        batch = []
+        for (obj_id, score), raw_data in zip(obj_ids, data):
+            if obj_id in titles:
+                sort_key = (score, self.create_key(titles[obj_id] or ''), obj_id)
+            else:
+                sort_key = (score, '', obj_id)
+            batch.append((sort_key, raw_data))
+        batch.sort(key=lambda item: item[0])
+        batch = batch[skip:]
+
+        if withscores:
+            return batch
+        return [raw_data for _, raw_data in batch]
+
+    @_operation
+    def search_json(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        if not mappers:
+            mappers = []
+        mappers.insert(0, json.loads)
+        return self.search(phrase, limit, filters, mappers, offset)
+
+    @_operation
+    def search_json_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
         if not mappers:
             mappers = []
         mappers.insert(0, json.loads)
-        return self.search(phrase, limit, filters, mappers)
+        return self.search_many(phrases, limit, filters, mappers, offset)
+
+    @_operation
+    def search_json_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        return self.search_iter(phrase, filters, [json.loads] + (mappers or []),
+                                offset, batch_size)
@@ -0,0 +1,256 @@
+import bisect
+import math
+import threading
+import time
+import types
+
+
+class Event(object):
+    """
+    Describes a single operation performed by an engine, e.g. a ``search``.
+    ``timings`` splits the wall time into the time spent tokenizing, scoring
+    and waiting on redis (``network``).
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.elapsed = 0.
+        self.timings = {'tokenize': 0., 'score': 0., 'network': 0.}
+        self.commands = 0
+        self.round_trips = 0
+
+        # searches only: the number of results before and after filtering,
+        # and whether the intersections and local cache could be used
+        self.candidates = None
+        self.results = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.local_cache = None
+
+    def __repr__(self):
+        return '<Event %s: %.2fms, %s commands, %s round-trips>' % (
+            self.operation, self.elapsed * 1000, self.commands, self.round_trips)
+
+
+class Instrumentation(object):
+    """
+    Tracks the event of the operation each thread is performing, passing
+    it to ``observer`` once the operation completes
+    """
+    def __init__(self, observer):
+        self.observer = observer
+        self._local = threading.local()
+
+    def current(self):
+        return getattr(self._local, 'event', None)
+
+    def run(self, operation, fn, *args, **kwargs):
+        # operations implemented in terms of other operations, like store_json,
+        # are reported once, as the outermost operation
+        if self.current() is not None:
+            return fn(*args, **kwargs)
+
+        event = self._local.event = Event(operation)
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            event.elapsed = time.time() - start
+            self._local.event = None
+
+        if operation.startswith('search') and isinstance(result, list):
+            if operation.endswith('_many'):
+                event.results = sum(len(r) for r in result)
+            else:
+                event.results = len(result)
+            if event.candidates is None:
+                event.candidates = event.results
+        self.observer(event)
+        return result
+
+    def record(self, phase, elapsed, commands=0, round_trips=0):
+        event = self.current()
+        if event is not None:
+            event.timings[phase] += elapsed
+            event.commands += commands
+            event.round_trips += round_trips
+
+    def timed(self, phase, fn):
+        def inner(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(phase, time.time() - start)
+        return inner
+
+
+class CountingClient(object):
+    """
+    Wraps a redis client, counting the commands and round-trips made through
+    it, including those made by pipelines, transactions and scripts
+    """
+    def __init__(self, client, instrumentation):
+        self._client = client
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(type(self._client), name, None)
+        if callable(attr):
+            # run the client's methods against the wrapper, so the commands
+            # they send pass through execute_command below
+            return types.MethodType(getattr(attr, '__func__', attr), self)
+        return getattr(self._client, name)
+
+    def _timed(self, fn, commands):
+        def inner(*args, **kwargs):
+            # a pipeline's commands are cleared once it has been executed
+            count = commands()
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._instrumentation.record(
+                    'network', time.time() - start, count, count and 1)
+        return inner
+
+    def execute_command(self, *args, **options):
+        return self._timed(self._client.execute_command, lambda: 1)(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._client.pipeline(*args, **kwargs)
+        pipe.execute = self._timed(pipe.execute, lambda: len(pipe.command_stack))
+        pipe.immediate_execute_command = self._timed(
+            pipe.immediate_execute_command, lambda: 1)
+        return pipe
+
+
+class TimedTokenizer(object):
+    """
+    Wraps a tokenizer, recording the time spent tokenizing
+    """
+    def __init__(self, tokenizer, instrumentation):
+        self._tokenizer = tokenizer
+        for name in ('tokenize', 'tokenize_many', 'prefixes', 'partial_keys'):
+            setattr(self, name, instrumentation.timed('tokenize', getattr(tokenizer, name)))
+
+    def __getattr__(self, name):
+        return getattr(self._tokenizer, name)
+
+
+class Histogram(object):
+    """
+    Counts values in logarithmic buckets, each ``precision`` wider than the
+    previous, so percentiles are accurate to within ``precision`` while the
+    memory used stays small
+    """
+    def __init__(self, precision=.01, minimum=1e-6):
+        self.precision = precision
+        self.minimum = minimum
+        self.count = 0
+        self.total = 0.
+        self.maximum = 0.
+        self._buckets = {}
+        self._log_base = math.log(1 + precision)
+
+    def add(self, value):
+        bucket = 0
+        if value > self.minimum:
+            bucket = int(math.log(value / self.minimum) / self._log_base) + 1
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        buckets = sorted(self._buckets)
+        cumulative = []
+        seen = 0
+        for bucket in buckets:
+            seen += self._buckets[bucket]
+            cumulative.append(seen)
+        idx = bisect.bisect_left(cumulative, max(1, int(math.ceil(p / 100. * self.count))))
+        bucket = buckets[idx]
+        if not bucket:
+            return self.minimum
+        return min(self.maximum, self.minimum * (1 + self.precision) ** bucket)
+
+    def mean(self):
+        return self.count and self.total / self.count or None
+
+
+class HistogramCollector(object):
+    """
+    An observer keeping histograms of the elapsed time, phase timings,
+    commands and round-trips of each operation, along with cache statistics
+
+        collector = HistogramCollector()
+        engine = RedisEngine(observer=collector)
+        ...
+        collector.summary()['search']['elapsed']['p99']
+    """
+    metrics = ('elapsed', 'tokenize', 'score', 'network', 'commands', 'round_trips',
+               'candidates', 'results')
+
+    def __init__(self, precision=.01, percentiles=(50, 90, 99)):
+        self.precision = precision
+        self.percentiles = percentiles
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        values = {
+            'elapsed': event.elapsed,
+            'commands': event.commands,
+            'round_trips': event.round_trips,
+            'candidates': event.candidates,
+            'results': event.results,
+        }
+        values.update(event.timings)
+
+        with self._lock:
+            for metric, value in values.items():
+                if value is None:
+                    continue
+                key = (event.operation, metric)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.precision)
+                self.histograms[key].add(value)
+
+            counters = self.counters.setdefault(event.operation, {})
+            for name, value in (('cache_hits', event.cache_hits),
+                                ('cache_misses', event.cache_misses),
+                                ('local_cache_' + str(event.local_cache), 1)):
+                counters[name] = counters.get(name, 0) + value
+            counters.pop('local_cache_None', None)
+
+    def percentile(self, operation, p, metric='elapsed'):
+        histogram = self.histograms.get((operation, metric))
+        return histogram and histogram.percentile(p)
+
+    def summary(self):
+        """
+        Return ``{operation: {metric: {'count', 'mean', 'max', 'p50', ...}}}``
+        along with the cache counters of each operation
+        """
+        with self._lock:
+            summary = {}
+            for (operation, metric), histogram in self.histograms.items():
+                stats = {
+                    'count': histogram.count,
+                    'mean': histogram.mean(),
+                    'max': histogram.maximum,
+                }
+                for p in self.percentiles:
+                    stats['p%s' % p] = histogram.percentile(p)
+                summary.setdefault(operation, {})[metric] = stats
+            for operation, counters in self.counters.items():
+                summary.setdefault(operation, {}).update(counters)
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
@@ -0,0 +1,258 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import bisect
+import threading
+import time
+import zlib
+from itertools import islice
+
+from redis_completion.cache import LRUCache
+from redis_completion.engine import BaseEngine
+from redis_completion.engine import _to_text
+from redis_completion.engine import _unpack_record
+from redis_completion.snapshot import DUMP
+from redis_completion.snapshot import HASH
+from redis_completion.snapshot import read_snapshot
+
+
+class MemoryEngine(BaseEngine):
+    """
+    Keeps the index in process memory, for tests and small embedded indexes.
+    Every prefix maps to a list of the objects indexed under it, sorted the
+    way redis orders a prefix set, so a search reads the head of a list
+    instead of making any round-trips.
+    """
+    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300,
+                 batch_size=1000, packed_scores=False, tokenizer=None, cache_size=1000):
+        super(MemoryEngine, self).__init__(
+            min_length, prefix, stop_words, cache_timeout, batch_size, packed_scores,
+            tokenizer)
+
+        # obj_id -> (sort key, title, data, partial keys), and prefix -> the
+        # sorted list of the sort keys of the objects indexed under it
+        self._objects = {}
+        self._index = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        # multi-word searches are cached like redis caches intersections,
+        # until the next write
+        self._intersections = LRUCache(cache_size, cache_timeout)
+
+    def generation(self):
+        return str(self._generation)
+
+    def flush(self, everything=False, batch_size=1000, rate_limit=None):
+        """
+        Remove every object.  The arguments are accepted for compatibility
+        with :py:class:`RedisEngine`.
+        """
+        with self._lock:
+            self._objects = {}
+            self._index = {}
+            self._generation += 1
+
+    def load_snapshot(self, path, codec=zlib):
+        """
+        Replace the index with the objects in a snapshot written by
+        :py:meth:`RedisEngine.export_index`, which is read through ``mmap``.
+        Returns the statistics of :py:meth:`store_many`.
+        """
+        titles, data, external_ids = {}, {}, {}
+        for kind, key, entries in read_snapshot(path, codec):
+            if kind == DUMP:
+                raise ValueError('Snapshots of dumped keys can only be imported into redis')
+            elif kind != HASH:
+                continue
+            if key == b't':
+                titles.update(entries)
+            elif key == b'd':
+                data.update(entries)
+            elif key == b'ir':
+                external_ids.update(entries)
+            elif key.startswith(b'r:'):
+                for obj_id, record in entries:
+                    titles[obj_id], data[obj_id] = _unpack_record(record, codec)
+
+        self.flush()
+        return self.store_many(
+            (_to_text(external_ids.get(obj_id, obj_id)), _to_text(title), data[obj_id])
+            for obj_id, title in titles.items() if data.get(obj_id) is not None)
+
+    def _sort_key(self, obj_id, words):
+        # scores are compared as the doubles redis stores, with ties ordered by
+        # id -- or, for packed scores, by title first
+        title_key = ' '.join(words)
+        return (float(self.score_key(title_key)),
+                self.packed_scores and title_key or '',
+                obj_id)
+
+    def _add(self, obj_id, title, data, words, unsorted=None):
+        """
+        Index an object, replacing any previous version of it.  When a set is
+        given, the prefixes whose lists are appended to instead of being kept
+        sorted are added to it.
+        """
+        self._discard(obj_id, unsorted)
+        sort_key = self._sort_key(obj_id, words)
+        partial_keys = frozenset(self.tokenizer.partial_keys(words))
+        self._objects[obj_id] = (sort_key, title, data, partial_keys)
+
+        for partial_key in partial_keys:
+            entries = self._index.setdefault(partial_key, [])
+            if unsorted is None:
+                bisect.insort(entries, sort_key)
+            else:
+                entries.append(sort_key)
+                unsorted.add(partial_key)
+
+    def _discard(self, obj_id, unsorted=None):
+        record = self._objects.pop(obj_id, None)
+        if record is None:
+            return
+
+        sort_key = record[0]
+        for partial_key in record[3]:
+            entries = self._index[partial_key]
+            if unsorted and partial_key in unsorted:
+                entries.remove(sort_key)
+            else:
+                del entries[bisect.bisect_left(entries, sort_key)]
+            if not entries:
+                del self._index[partial_key]
+
+    def store(self, obj_id, title=None, data=None):
+        obj_id, title, data, _ = self._normalize(obj_id, title, data)
+        words = self.clean_phrase(title)
+        with self._lock:
+            self._add('%s' % obj_id, title, data, words)
+            self._generation += 1
+
+    def store_json(self, obj_id, title, data_dict):
+        return self.store(obj_id, title, json.dumps(data_dict))
+
+    def update(self, obj_id, title=None, data=None):
+        """
+        Storing an object always removes it from the prefixes of its previous
+        title, so this is the same as :py:meth:`store`
+        """
+        return self.store(obj_id, title, data)
+
+    def update_json(self, obj_id, title, data_dict):
+        return self.store(obj_id, title, json.dumps(data_dict))
+
+    def store_many(self, objects, chunk_size=1000):
+        """
+        Store an iterable of ``(obj_id[, title[, data]])`` tuples.  The objects
+        are tokenized and indexed ``chunk_size`` at a time, sorting each prefix
+        list once per chunk.  Returns a dictionary of throughput statistics.
+        """
+        stats = {'objects': 0}
+        start = time.time()
+
+        objects = iter(objects)
+        while True:
+            batch = [self._normalize(*obj) for obj in islice(objects, chunk_size)]
+            if not batch:
+                break
+
+            words = self.tokenizer.tokenize_many([obj[1] for obj in batch])
+            with self._lock:
+                unsorted = set()
+                for (obj_id, title, data, _), title_words in zip(batch, words):
+                    self._add('%s' % obj_id, title, data, title_words, unsorted)
+                for partial_key in unsorted:
+                    if partial_key in self._index:
+                        self._index[partial_key].sort()
+                self._generation += 1
+            stats['objects'] += len(batch)
+
+        elapsed = time.time() - start
+        stats['elapsed'] = elapsed
+        stats['objects_per_sec'] = elapsed and stats['objects'] / elapsed or 0.
+        return stats
+
+    def store_json_many(self, objects, chunk_size=1000):
+        return self.store_many(
+            ((obj[0], obj[1], json.dumps(obj[2])) for obj in objects),
+            chunk_size)
+
+    def remove(self, obj_id):
+        self.remove_many([obj_id])
+
+    def remove_many(self, obj_ids, chunk_size=1000):
+        obj_ids = ['%s' % obj_id for obj_id in obj_ids]
+        for i in range(0, len(obj_ids), chunk_size):
+            with self._lock:
+                for obj_id in obj_ids[i:i + chunk_size]:
+                    self._discard(obj_id)
+                self._generation += 1
+
+    def _matches(self, cleaned):
+        """
+        Return the sorted list of the sort keys of the objects indexed under
+        every one of the given words.  Must be called holding the lock.
+        """
+        if len(cleaned) == 1:
+            return self._index.get(cleaned[0], ())
+
+        cache_key = '|'.join(cleaned)
+        matches = self._intersections.get(cache_key, self._generation)
+        if matches is None:
+            lists = [self._index.get(w) for w in cleaned]
+            if not all(lists):
+                return ()
+
+            # scan the shortest list, checking the prefixes of each object
+            # against the other words
+            words = set(cleaned)
+            objects = self._objects
+            matches = [sort_key for sort_key in min(lists, key=len)
+                       if words.issubset(objects[sort_key[-1]][3])]
+            self._intersections.set(cache_key, matches, self._generation)
+        return matches
+
+    def _search_batches(self, cleaned, offset, batch_size):
+        if not cleaned:
+            return
+
+        start = offset
+        while True:
+            with self._lock:
+                window = self._matches(cleaned)[start:start + batch_size]
+                batch = [self._objects[sort_key[-1]][2] for sort_key in window]
+            if not batch:
+                break
+            yield batch
+
+            if len(batch) < batch_size:
+                break
+            start += batch_size
+            batch_size = self._next_batch_size(batch_size)
+
+    def search(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        batches = self._search_batches(
+            self.clean_phrase(phrase), offset, self._first_batch_size(limit, filters))
+        return list(islice(self._results(batches, filters, mappers), limit or None))
+
+    def search_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
+        return [self.search(phrase, limit, filters, mappers, offset)
+                for phrase in phrases]
+
+    def search_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        batches = self._search_batches(
+            self.clean_phrase(phrase), offset, batch_size or self.batch_size)
+        return self._results(batches, filters, mappers)
+
+    def search_json(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        return self.search(phrase, limit, filters, [json.loads] + (mappers or []), offset)
+
+    def search_json_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
+        return self.search_many(
+            phrases, limit, filters, [json.loads] + (mappers or []), offset)
+
+    def search_json_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        return self.search_iter(phrase, filters, [json.loads] + (mappers or []),
+                                offset, batch_size)
@@ -0,0 +1,235 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import threading
+import time
+from itertools import groupby
+from itertools import islice
+
+from redis_completion.engine import BaseEngine
+from redis_completion.engine import RedisEngine
+from redis_completion.engine import _to_bytes
+from redis_completion.engine import _to_text
+from redis_completion.memory import MemoryEngine
+
+
+logger = logging.getLogger(__name__)
+
+class ReplicatedEngine(BaseEngine):
+    """
+    Serves searches from a copy of an index kept in process memory.  Writes
+    go to redis, which publishes every change; a background thread loads the
+    index when the engine is created, then applies the changes as they are
+    published.  Changes are numbered, and the copy is reloaded whenever one
+    goes missing.
+    """
+    def __init__(self, min_length=2, prefix='ac', stop_words=None, cache_timeout=300,
+                 batch_size=1000, packed_scores=False, tokenizer=None, cache_size=1000,
+                 poll_interval=1, timeout=30, **engine_kwargs):
+        super(ReplicatedEngine, self).__init__(
+            min_length, prefix, stop_words, cache_timeout, batch_size, packed_scores,
+            tokenizer)
+
+        self.engine = RedisEngine(
+            prefix=prefix, cache_timeout=cache_timeout, batch_size=batch_size,
+            packed_scores=packed_scores, tokenizer=self.tokenizer,
+            publish_changes=True, **engine_kwargs)
+        self.cache_size = cache_size
+        self.poll_interval = poll_interval
+
+        # data is kept the way the redis client returns it
+        connection_kwargs = self.engine.client.connection_pool.connection_kwargs
+        self._decode_data = connection_kwargs.get('decode_responses')
+
+        # the copy being searched, and the sequence number of the last change
+        # applied to it
+        self.replica = None
+        self.sequence = None
+        self.reloads = 0
+        self._applied = threading.Condition()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+        if not self.catch_up(timeout):
+            raise RuntimeError('Timed out loading the index')
+
+    def close(self):
+        """
+        Stop applying changes
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def catch_up(self, timeout=5):
+        """
+        Wait until every change made before the call has been applied,
+        returning ``False`` if that takes longer than ``timeout`` seconds
+        """
+        target = int(self.engine.client.get(self.engine.sequence_key) or 0)
+        deadline = time.time() + timeout
+        with self._applied:
+            while self.sequence is None or self.sequence < target:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._thread.is_alive():
+                    return False
+                self._applied.wait(remaining)
+        return True
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            pubsub = self.engine.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                # subscribe first, so the changes made while loading are
+                # buffered until they can be applied
+                pubsub.subscribe(self.engine.changes_channel)
+                self._load()
+                self._follow(pubsub)
+            except Exception:
+                # whatever went wrong, the copy is reloaded rather than left
+                # to go stale
+                logger.exception('Error following changes, reloading the index')
+                self._stopped.wait(self.poll_interval)
+            finally:
+                pubsub.close()
+
+    def _follow(self, pubsub):
+        """
+        Apply published changes until one is missed or the engine is closed
+        """
+        expected = None
+        while not self._stopped.is_set():
+            message = pubsub.get_message(timeout=self.poll_interval)
+            if message is not None:
+                if not self._receive(message['data']):
+                    return
+                continue
+
+            # when a change is published after the last one received, it is
+            # sent before the sequence can be read, so if it has not arrived
+            # by the next poll it was lost
+            if expected is not None and self.sequence < expected:
+                return
+            expected = int(self.engine.client.get(self.engine.sequence_key) or 0)
+
+    def _receive(self, message):
+        """
+        Apply a published change, returning ``False`` if the index has to be
+        reloaded instead
+        """
+        try:
+            sequence, changes = _to_bytes(message).split(b' ', 1)
+            sequence, changes = int(sequence), json.loads(changes)
+        except ValueError:
+            # a message that cannot be read may have been a change
+            logger.warning('Unreadable change %r, reloading the index', message)
+            return False
+
+        if sequence <= self.sequence:
+            # already part of the index that was loaded
+            return True
+        elif sequence != self.sequence + 1:
+            return False
+
+        for operation, group in groupby(changes, lambda c: c[0]):
+            if operation == 'store':
+                self.replica.store_many(
+                    (obj_id, title, self._data(data)) for _, obj_id, title, data in group)
+            elif operation == 'remove':
+                self.replica.remove_many([obj_id for _, obj_id in group])
+            elif operation == 'flush':
+                self.replica.flush()
+            else:
+                return False
+
+        with self._applied:
+            self.sequence = sequence
+            self._applied.notify_all()
+        return True
+
+    def _data(self, data):
+        if self._decode_data:
+            return data
+        return _to_bytes(data)
+
+    def _load(self):
+        """
+        Copy the index from redis, replacing the current copy
+        """
+        replica = MemoryEngine(
+            cache_timeout=self.cache_timeout, batch_size=self.batch_size,
+            packed_scores=self.packed_scores, tokenizer=self.tokenizer,
+            cache_size=self.cache_size)
+        sequence = int(self.engine.client.get(self.engine.sequence_key) or 0)
+
+        source = self.engine
+        if source.alias_key is not None:
+            source = source._resolve()
+        titles = source._iter_titles(self.batch_size)
+        while True:
+            batch = list(islice(titles, self.batch_size))
+            if not batch:
+                break
+            data = source._fetch_data([obj_id for obj_id, _ in batch])
+            replica.store_many(
+                (_to_text(obj_id), _to_text(title), raw_data)
+                for (obj_id, title), raw_data in zip(batch, data)
+                if raw_data is not None)
+
+        with self._applied:
+            self.replica, self.sequence = replica, sequence
+            self.reloads += 1
+            self._applied.notify_all()
+
+    def flush(self, everything=False, batch_size=1000, rate_limit=None):
+        self.engine.flush(everything, batch_size, rate_limit)
+
+    def store(self, obj_id, title=None, data=None, boost=None):
+        self.engine.store(obj_id, title, data, boost)
+
+    def store_json(self, obj_id, title, data_dict, boost=None):
+        self.engine.store_json(obj_id, title, data_dict, boost)
+
+    def update(self, obj_id, title=None, data=None, boost=None):
+        self.engine.update(obj_id, title, data, boost)
+
+    def update_json(self, obj_id, title, data_dict, boost=None):
+        self.engine.update_json(obj_id, title, data_dict, boost)
+
+    def store_many(self, objects, chunk_size=1000, transaction=True):
+        return self.engine.store_many(objects, chunk_size, transaction)
+
+    def store_json_many(self, objects, chunk_size=1000, transaction=True):
+        return self.engine.store_json_many(objects, chunk_size, transaction)
+
+    def remove(self, obj_id):
+        self.engine.remove(obj_id)
+
+    def remove_many(self, obj_ids, chunk_size=1000):
+        self.engine.remove_many(obj_ids, chunk_size)
+
+    def rebuild(self, objects, chunk_size=1000, transaction=False, background=True,
+                batch_size=1000, rate_limit=None, drop_delay=60):
+        return self.engine.rebuild(objects, chunk_size, transaction, background,
+                                   batch_size, rate_limit, drop_delay)
+
+    def search(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        return self.replica.search(phrase, limit, filters, mappers, offset)
+
+    def search_json(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        return self.replica.search_json(phrase, limit, filters, mappers, offset)
+
+    def search_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
+        return self.replica.search_many(phrases, limit, filters, mappers, offset)
+
+    def search_json_many(self, phrases, limit=None, filters=None, mappers=None, offset=0):
+        return self.replica.search_json_many(phrases, limit, filters, mappers, offset)
+
+    def search_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        return self.replica.search_iter(phrase, filters, mappers, offset, batch_size)
+
+    def search_json_iter(self, phrase, filters=None, mappers=None, offset=0, batch_size=None):
+        return self.replica.search_json_iter(phrase, filters, mappers, offset, batch_size)
@@ -0,0 +1,220 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import bisect
+import hashlib
+import heapq
+import time
+from itertools import chain
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from redis_completion.engine import BaseEngine
+from redis_completion.engine import RedisEngine
+
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = ('%s' % key).encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring.  Each node is placed on the ring ``replicas``
+    times, so that adding a node only moves roughly ``1/N`` of the keys.
+    """
+    def __init__(self, nodes=None, replicas=100):
+        self.replicas = replicas
+        self._ring = []
+        self._nodes = {}
+        for node in nodes or ():
+            self.add_node(node)
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            point = _hash('%s:%s' % (node, i))
+            self._nodes[point] = node
+            bisect.insort(self._ring, point)
+
+    def get_node(self, key):
+        if not self._ring:
+            raise ValueError('The hash ring does not contain any nodes')
+        idx = bisect.bisect(self._ring, _hash(key)) % len(self._ring)
+        return self._nodes[self._ring[idx]]
+
+
+class ShardedEngine(BaseEngine):
+    """
+    Spreads an index across several redis servers.  Objects are assigned to a
+    node by hashing their ``obj_id``, and searches are run against every node
+    in parallel, with the results merged in score order.
+    """
+    def __init__(self, nodes, min_length=2, prefix='ac', stop_words=None,
+                 cache_timeout=300, batch_size=1000, replicas=100, tokenizer=None,
+                 **engine_kwargs):
+        super(ShardedEngine, self).__init__(
+            min_length, prefix, stop_words, cache_timeout, batch_size,
+            tokenizer=tokenizer)
+
+        self.engine_kwargs = engine_kwargs
+        self.engines = {}
+        self.ring = HashRing(replicas=replicas)
+        self._pool = None
+
+        for name, conn_kwargs in nodes.items():
+            self.add_node(name, conn_kwargs, rebalance=False)
+
+    def add_node(self, name, conn_kwargs, rebalance=True):
+        """
+        Add a node to the cluster.  Unless ``rebalance`` is ``False``, the
+        objects that now hash to the new node are moved to it.
+        """
+        kwargs = dict(self.engine_kwargs, **conn_kwargs)
+        self.engines[name] = RedisEngine(
+            prefix=self.prefix, cache_timeout=self.cache_timeout,
+            batch_size=self.batch_size, tokenizer=self.tokenizer, **kwargs)
+        self.ring.add_node(name)
+
+        if self._pool is not None:
+            self._pool.close()
+        self._pool = ThreadPool(len(self.engines))
+
+        if rebalance:
+            return self.rebalance()
+
+    def get_engine(self, obj_id):
+        return self.engines[self.ring.get_node(obj_id)]
+
+    def _map(self, fn, items):
+        return self._pool.map(lambda item: fn(*item), items)
+
+    def _group(self, objects, key=lambda obj: obj):
+        groups = {}
+        for obj in objects:
+            groups.setdefault(self.ring.get_node(key(obj)), []).append(obj)
+        return groups
+
+    def flush(self, everything=False, batch_size=1000, rate_limit=None):
+        self._map(
+            lambda name, engine: engine.flush(everything, batch_size, rate_limit),
+            self.engines.items())
+
+    def store(self, obj_id, title=None, data=None, boost=None):
+        self.get_engine(obj_id).store(obj_id, title, data, boost)
+
+    def store_json(self, obj_id, title, data_dict, boost=None):
+        return self.store(obj_id, title, json.dumps(data_dict), boost)
+
+    def update(self, obj_id, title=None, data=None, boost=None):
+        self.get_engine(obj_id).update(obj_id, title, data, boost)
+
+    def update_json(self, obj_id, title, data_dict, boost=None):
+        return self.update(obj_id, title, json.dumps(data_dict), boost)
+
+    def store_many(self, objects, chunk_size=1000, transaction=True):
+        """
+        Store an iterable of ``(obj_id[, title[, data[, boost]]])`` tuples.  Every
+        ``chunk_size`` objects, the objects read so far are written to their
+        nodes in parallel.
+        """
+        stats = {'objects': 0, 'commands': 0, 'flushes': 0}
+        start = time.time()
+
+        def write(name, objs):
+            return self.engines[name].store_many(objs, chunk_size, transaction)
+
+        def flush(buf):
+            for node_stats in self._map(write, self._group(buf, lambda o: o[0]).items()):
+                for key in ('objects', 'commands', 'flushes'):
+                    stats[key] += node_stats[key]
+
+        buf = []
+        for obj in objects:
+            buf.append(obj)
+            if len(buf) == chunk_size:
+                flush(buf)
+                buf = []
+        if buf:
+            flush(buf)
+
+        elapsed = time.time() - start
+        stats['elapsed'] = elapsed
+        stats['objects_per_sec'] = elapsed and stats['objects'] / elapsed or 0.
+        stats['commands_per_flush'] = (
+            stats['flushes'] and float(stats['commands']) / stats['flushes'] or 0.)
+        return stats
+
+    def store_json_many(self, objects, chunk_size=1000, transaction=True):
+        return self.store_many(
+            ((obj[0], obj[1], json.dumps(obj[2])) + tuple(obj[3:])
+             for obj in objects),
+            chunk_size,
+            transaction)
+
+    def record_hit(self, obj_id, weight=1):
+        return self.get_engine(obj_id).record_hit(obj_id, weight)
+
+    def remove(self, obj_id):
+        self.get_engine(obj_id).remove(obj_id)
+
+    def remove_many(self, obj_ids, chunk_size=1000):
+        self._map(
+            lambda name, ids: self.engines[name].remove_many(ids, chunk_size),
+            self._group(obj_ids).items())
+
+    def rebalance(self, batch_size=1000):
+        """
+        Move every object that is not stored on the node it hashes to, e.g.
+        after a node has been added.  Returns the number of objects moved.
+        """
+        moved = 0
+        for name, engine in list(self.engines.items()):
+            batch = []
+            for obj_id, title in engine._iter_titles(batch_size):
+                if self.ring.get_node(obj_id) != name:
+                    batch.append((obj_id, title))
+                if len(batch) == batch_size:
+                    moved += self._move(engine, batch)
+                    batch = []
+            if batch:
+                moved += self._move(engine, batch)
+        return moved
+
+    def _move(self, source, batch):
+        obj_ids = [obj_id for obj_id, _ in batch]
+        data = source._fetch_data(obj_ids)
+        self.store_many(
+            (obj_id, title, raw_data)
+            for (obj_id, title), raw_data in zip(batch, data))
+        source.remove_many(obj_ids)
+        return len(obj_ids)
+
+    def _scored_results(self, engine, cleaned, batch_size):
+        # fetch the first window eagerly (this runs on the thread pool), the
+        # rest is fetched lazily while the results are merged
+        batches = engine._search_batches(cleaned, 0, batch_size, withscores=True)
+        return chain(next(batches, []), chain.from_iterable(batches))
+
+    def search(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        cleaned = self.clean_phrase(phrase)
+        if not cleaned:
+            return []
+
+        # every node has to supply enough results to cover the offset
+        batch_size = self._first_batch_size(limit, filters) + offset
+        streams = self._map(
+            lambda engine: self._scored_results(engine, cleaned, batch_size),
+            [(engine,) for engine in self.engines.values()])
+
+        # merge by the sort key each node ordered its results by
+        merged = islice(heapq.merge(*streams), offset, None)
+        batches = [(raw_data for _, raw_data in merged)]
+        return list(islice(self._results(batches, filters, mappers), limit or None))
+
+    def search_json(self, phrase, limit=None, filters=None, mappers=None, offset=0):
+        if not mappers:
+            mappers = []
+        mappers.insert(0, json.loads)
+        return self.search(phrase, limit, filters, mappers, offset)
@@ -0,0 +1,139 @@
+"""
+A compact file format for copies of an index.
+
+A snapshot starts with ``MAGIC``, followed by a series of blocks, each holding
+some of the entries of a single redis key.  A block is a header, giving the
+type of the key, whether the payload is compressed and the sizes of the
+payload before and after compression, followed by the payload: the name of
+the key and its entries, with every string prefixed by its length, or for
+keys copied using DUMP, the serialized value.  Large keys
+are split over several blocks, so neither writing nor reading a snapshot ever
+needs more than a block in memory, and the file can be read through ``mmap``.
+"""
+import mmap
+import struct
+import zlib
+from itertools import islice
+
+
+MAGIC = b'RCSNAP\x00\x01'
+
+HASH = b'h'
+ZSET = b'z'
+SET = b's'
+STRING = b'k'
+DUMP = b'd'
+
+COMPRESSED = 1
+
+_BLOCK = struct.Struct('>cBII')
+_LENGTH = struct.Struct('>I')
+_SCORE = struct.Struct('>d')
+
+
+def _pack(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return _LENGTH.pack(len(value)) + value
+
+
+def _unpack(payload, offset):
+    size, = _LENGTH.unpack_from(payload, offset)
+    offset += _LENGTH.size
+    return payload[offset:offset + size], offset + size
+
+
+class SnapshotWriter(object):
+    """
+    Writes blocks to a file opened in binary mode.  Payloads longer than
+    ``compress_threshold`` bytes are compressed using ``codec``, when given,
+    if that makes them smaller.
+    """
+    def __init__(self, fh, codec=None, compress_threshold=256):
+        self.fh = fh
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.bytes = len(MAGIC)
+        fh.write(MAGIC)
+
+    def _entry(self, kind, entry):
+        if kind == HASH:
+            return _pack(entry[0]) + _pack(entry[1])
+        elif kind == ZSET:
+            return _pack(entry[0]) + _SCORE.pack(entry[1])
+        return _pack(entry)
+
+    def write(self, kind, key, entries, block_size=1000):
+        """
+        Write the entries of a key in blocks of up to ``block_size`` entries.
+        Hash entries are ``(field, value)`` tuples, sorted set entries are
+        ``(member, score)`` tuples, and set and string entries are strings.
+        Returns the number of entries written.
+        """
+        entries = iter(entries)
+        written = 0
+        while True:
+            chunk = list(islice(entries, block_size))
+            if chunk or not written:
+                payload = _pack(key) + b''.join(self._entry(kind, e) for e in chunk)
+                self._write_block(kind, payload)
+                written += len(chunk)
+            if len(chunk) < block_size:
+                return written
+
+    def _write_block(self, kind, payload):
+        flags, stored = 0, payload
+        if self.codec is not None and len(payload) > self.compress_threshold:
+            compressed = self.codec.compress(payload)
+            if len(compressed) < len(payload):
+                flags, stored = COMPRESSED, compressed
+
+        self.fh.write(_BLOCK.pack(kind, flags, len(payload), len(stored)))
+        self.fh.write(stored)
+        self.bytes += _BLOCK.size + len(stored)
+
+
+def _decode_block(kind, payload):
+    key, offset = _unpack(payload, 0)
+    entries = []
+    while offset < len(payload):
+        if kind == HASH:
+            field, offset = _unpack(payload, offset)
+            value, offset = _unpack(payload, offset)
+            entries.append((field, value))
+        elif kind == ZSET:
+            member, offset = _unpack(payload, offset)
+            score, = _SCORE.unpack_from(payload, offset)
+            offset += _SCORE.size
+            entries.append((member, score))
+        else:
+            value, offset = _unpack(payload, offset)
+            entries.append(value)
+    return key, entries
+
+
+def read_snapshot(path, codec=zlib):
+    """
+    Iterate over the blocks of a snapshot, as ``(kind, key, entries)``
+    tuples.  The file is memory-mapped and read a block at a time.
+    """
+    with open(path, 'rb') as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError('%s is not an index snapshot' % path)
+
+            offset = len(MAGIC)
+            while offset < len(data):
+                kind, flags, size, stored = _BLOCK.unpack_from(data, offset)
+                offset += _BLOCK.size
+                payload = data[offset:offset + stored]
+                offset += stored
+                if flags & COMPRESSED:
+                    payload = codec.decompress(payload)
+                if len(payload) != size:
+                    raise ValueError('%s is truncated or corrupt' % path)
+                key, entries = _decode_block(kind, payload)
+                yield kind, key, entries
+        finally:
+            data.close()
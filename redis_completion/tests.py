@@ -1,14 +1,44 @@
+import os
 import random
+import shutil
+import tempfile
+import time
 from unittest import TestCase
+from unittest import skipIf
 
+from redis.exceptions import ResponseError
+from redis.exceptions import WatchError
+
+from redis_completion.cache import LRUCache
 from redis_completion.engine import RedisEngine
+from redis_completion.instrumentation import Histogram
+from redis_completion.instrumentation import HistogramCollector
+from redis_completion.memory import MemoryEngine
+from redis_completion.replicated import ReplicatedEngine
+from redis_completion import snapshot
+from redis_completion.sharded import ShardedEngine
+from redis_completion.tokenizer import Tokenizer
+try:
+    import asyncio
+    from redis_completion.async_engine import AsyncRedisEngine
+except (ImportError, SyntaxError):
+    AsyncRedisEngine = None
 
 
 stop_words = set(['a', 'an', 'the', 'of'])
 
-class RedisCompletionTestCase(TestCase):
+def connection(db):
+    return {'db': db, 'decode_responses': True}
+
+class EngineTests(object):
+    """
+    Tests run against every engine, which subclasses create using get_engine()
+    """
+    def get_engine(self, **kwargs):
+        raise NotImplementedError
+
     def setUp(self):
-        self.engine = RedisEngine(prefix='testac', db=15)
+        self.engine = self.get_engine()
         self.engine.flush()
 
     def store_data(self, id=None):
@@ -58,6 +88,27 @@ class RedisCompletionTestCase(TestCase):
         results = self.engine.search_json('missing')
         self.assertEqual(results, [])
 
+    def test_store_many(self):
+        stats = self.engine.store_json_many((
+            (obj_id, title, {'obj_id': obj_id, 'title': title})
+            for obj_id, title in (
+                (1, 'testing python'),
+                (2, 'testing python code'),
+                (3, 'unit tests with python'),
+            )), chunk_size=5)
+
+        self.assertEqual(stats['objects'], 3)
+
+        results = self.engine.search_json('testing')
+        self.assertEqual(self.sort_results(results), [
+            {'obj_id': 1, 'title': 'testing python'},
+            {'obj_id': 2, 'title': 'testing python code'},
+        ])
+
+        self.engine.store_many([('testing ruby',), (5, 'web testing')])
+        self.assertEqual(self.engine.search('testing ru'), ['testing ruby'])
+        self.assertEqual(self.engine.search('web'), ['web testing'])
+
     def test_limit(self):
         self.store_data()
 
@@ -77,6 +128,70 @@ class RedisCompletionTestCase(TestCase):
             {'obj_id': 3, 'title': 'web testing python code', 'secret': 'herp'},
         ])
 
+    def test_search_batches(self):
+        engine = self.get_engine(batch_size=2)
+        titles = ['python %s' % c for c in 'abcdefg']
+        engine.store_many((t,) for t in titles)
+
+        self.assertEqual(engine.search('python'), titles)
+        self.assertEqual(engine.search('python', limit=3), titles[:3])
+
+        f = lambda i: i > 'python d'
+        self.assertEqual(engine.search('python', limit=2, filters=[f]),
+                         ['python e', 'python f'])
+        self.assertEqual(engine.search('python', filters=[f]), titles[4:])
+
+    def test_offset(self):
+        titles = ['python %s' % c for c in 'abcdefg']
+        self.engine.store_many((t,) for t in titles)
+
+        self.assertEqual(self.engine.search('python', offset=2), titles[2:])
+        self.assertEqual(self.engine.search('python', limit=2, offset=3),
+                         titles[3:5])
+        self.assertEqual(self.engine.search('python', offset=7), [])
+
+        f = lambda i: i != 'python e'
+        self.assertEqual(
+            self.engine.search('python', limit=2, offset=3, filters=[f]),
+            ['python d', 'python f'])
+
+    def test_search_many(self):
+        self.store_data()
+        phrases = ['testing', 'testing code', 'python', 'testing code', '', 'pyt xylo', 'web']
+        self.assertEqual(self.engine.search_json_many(phrases),
+                         [self.engine.search_json(p) for p in phrases])
+        self.assertEqual(self.engine.search_json_many(phrases, limit=1, offset=1),
+                         [self.engine.search_json(p, limit=1, offset=1) for p in phrases])
+
+        filters = [lambda d: d['obj_id'] != 2]
+        self.assertEqual(self.engine.search_json_many(phrases, limit=1, filters=filters),
+                         [self.engine.search_json(p, limit=1, filters=filters)
+                          for p in phrases])
+
+        engine = self.get_engine(batch_size=1, packed_scores=True)
+        engine.flush()
+        engine.store_many([(1, 'python'), (2, 'python code'), (3, 'pyramid')])
+        self.assertEqual(engine.search_many(['py', 'py code', 'xy']),
+                         [['pyramid', 'python', 'python code'], ['python code'], []])
+
+    def test_search_iter(self):
+        titles = ['python %s' % c for c in 'abcdefg']
+        self.engine.store_many((t,) for t in titles)
+
+        results = self.engine.search_iter('python', batch_size=2)
+        self.assertEqual(next(results), 'python a')
+        self.assertEqual(list(results), titles[1:])
+
+        results = self.engine.search_iter('python', offset=5, batch_size=1)
+        self.assertEqual(list(results), titles[5:])
+
+        self.assertEqual(list(self.engine.search_iter('')), [])
+        self.assertEqual(list(self.engine.search_iter('missing')), [])
+
+        self.store_data()
+        results = self.engine.search_json_iter('testing python code')
+        self.assertEqual([r['obj_id'] for r in results], [2, 3])
+
     def test_simple(self):
         self.engine.print_scores = True
         self.engine.store('testing python')
@@ -108,6 +223,57 @@ class RedisCompletionTestCase(TestCase):
         results = self.engine.search('aaa', limit=30)
         self.assertEqual(results, sorted(strings)[:30])
 
+    def test_score_key(self):
+        def legacy_score_key(k, max_size=20):
+            k_len = len(k)
+            a = ord('a') - 2
+            score = 0
+
+            for i in range(max_size):
+                if i < k_len:
+                    c = (ord(k[i]) - a)
+                    if c < 2 or c > 27:
+                        c = 1
+                else:
+                    c = 1
+                score += c*(27**(max_size-i))
+            return score
+
+        for k in ('', 'a', 'zz', 'testing python', 'web-2 code_x', 'z' * 30):
+            self.assertEqual(self.engine.score_key(k), legacy_score_key(k))
+            self.assertEqual(self.engine.score_key(k, 5), legacy_score_key(k, 5))
+
+        packed = self.get_engine(packed_scores=True)
+        scores = [packed.score_key(k) for k in ('', 'a', 'aa', 'ab', 'b', 'z' * 30)]
+        self.assertEqual(scores, sorted(scores))
+        self.assertTrue(scores[-1] < 2 ** 53)
+        self.assertEqual(scores[-1], float(scores[-1]))
+
+    def test_packed_score_ties(self):
+        engine = self.get_engine(packed_scores=True, batch_size=3)
+
+        # the titles only differ after the characters a packed score covers,
+        # and the ids sort in the opposite order of the titles
+        titles = ['abcdefghijkl%s' % c for c in 'abcdefgh'] + ['abcdefghijz', 'abd']
+        engine.store_many((-i, title) for i, title in enumerate(titles))
+
+        self.assertEqual(engine.search('abc'), titles[:-1])
+        self.assertEqual(engine.search('ab'), titles)
+        self.assertEqual(engine.search('ab', limit=4), titles[:4])
+        self.assertEqual(engine.search('ab abcd'), titles[:-1])
+        self.assertEqual(list(engine.search_iter('ab', batch_size=2)), titles)
+
+        # offsets falling part way through a tie skip the objects ranked
+        # before them, not the ones sliced off by id
+        matches = titles[:-1]
+        for offset in range(len(matches) + 1):
+            self.assertEqual(engine.search('abc', limit=2, offset=offset),
+                             matches[offset:offset + 2])
+            self.assertEqual(list(engine.search_iter('abc', offset=offset, batch_size=2)),
+                             matches[offset:])
+        self.assertEqual(engine.search_many(['abc', 'ab'], limit=3, offset=4),
+                         [matches[4:7], titles[4:7]])
+
     def test_removing_objects(self):
         self.store_data()
 
@@ -128,6 +294,496 @@ class RedisCompletionTestCase(TestCase):
             {'obj_id': 3, 'title': 'web testing python code', 'secret': 'herp'},
         ])
 
+    def test_clean_phrase(self):
+        self.assertEqual(self.engine.clean_phrase('abc def ghi'), ['abc', 'def', 'ghi'])
+
+        self.assertEqual(self.engine.clean_phrase('a A tHe an a'), [])
+        self.assertEqual(self.engine.clean_phrase(''), [])
+
+        self.assertEqual(
+            self.engine.clean_phrase('The Best of times, the blurst of times'),
+            ['best', 'times', 'blurst', 'times'])
+
+    def test_tokenizer(self):
+        tokenizer = Tokenizer(min_length=3, stop_words=stop_words, cache_size=2)
+        phrases = ['The Best of times', '', 'multi\nline  phrase', 'a an',
+                   'web-2 code_x!', ' trailing\n']
+        self.assertEqual(tokenizer.tokenize_many(phrases),
+                         [tokenizer.tokenize(p) for p in phrases])
+        self.assertEqual(tokenizer.tokenize_many([]), [])
+
+        self.assertEqual(tokenizer.prefixes('python'),
+                         ('pyt', 'pyth', 'pytho', 'python'))
+        self.assertEqual(tokenizer.prefixes('py'), ('py',))
+        self.assertEqual(tokenizer.partial_keys(['code', 'cod']),
+                         set(['cod', 'code']))
+
+        engine = self.get_engine(tokenizer=tokenizer)
+        self.assertEqual(engine.min_length, 3)
+        engine.store_many([('testing python',), ('tests',)])
+        engine.store('the python code')
+        self.assertEqual(engine.search('tes'), ['testing python', 'tests'])
+        self.assertEqual(engine.search('te'), [])
+        self.assertEqual(engine.search('the pyt'), ['the python code', 'testing python'])
+
+
+class RedisCompletionTestCase(EngineTests, TestCase):
+    def get_engine(self, **kwargs):
+        return RedisEngine(prefix='testac', **dict(connection(15), **kwargs))
+
+    def test_store_many_stats(self):
+        stats = self.engine.store_many(
+            ((i, 'testing %s' % i) for i in range(3)), chunk_size=5, transaction=False)
+        self.assertEqual(stats['objects'], 3)
+        self.assertTrue(stats['flushes'] > 1)
+        self.assertEqual(stats['commands_per_flush'],
+                         float(stats['commands']) / stats['flushes'])
+
+    def test_missing_word(self):
+        self.store_data()
+
+        # a word without a prefix set ends the search before intersecting
+        self.assertEqual(self.engine.search('testing xylophone'), [])
+        self.assertFalse(self.engine.client.keys(self.engine.cache_prefix + '*'))
+        self.assertEqual(len(self.engine.search('testing code')), 2)
+
+    def test_scripted_search(self):
+        scripted = RedisEngine(prefix='testac', scripted_search=True,
+                               batch_size=2, **connection(15))
+        self.store_data()
+        scripted.store_many((t,) for t in ['python %s' % c for c in 'abcde'])
+
+        f = lambda i: i['secret'] == 'herp'
+        for phrase, kwargs in (
+                ('testing python', {}),
+                ('test', {'limit': 2}),
+                ('test', {'limit': 1, 'filters': [f]}),
+                ('missing', {})):
+            # run the scripted search twice to exercise the cached intersection
+            for i in range(2):
+                self.assertEqual(
+                    scripted.search_json(phrase, **kwargs),
+                    self.engine.search_json(phrase, **kwargs))
+
+        for kwargs in ({}, {'limit': 3}):
+            self.assertEqual(scripted.search('python', **kwargs),
+                             self.engine.search('python', **kwargs))
+        self.assertIn(scripted.client.ttl(scripted.search_key('python')), (None, -1))
+
+    def test_scripted_search_fallback(self):
+        engine = RedisEngine(prefix='testac', scripted_search=True, **connection(15))
+        def unavailable(*args, **kwargs):
+            raise ResponseError('unknown command EVALSHA')
+        engine._search_script = unavailable
+
+        self.store_data()
+        results = engine.search_json('unit')
+        self.assertEqual(results, [
+            {'obj_id': 4, 'title': 'unit tests with python', 'secret': 'derp'},
+        ])
+        self.assertFalse(engine.scripted_search)
+
+    def test_local_cache(self):
+        engine = RedisEngine(prefix='testac', local_cache_size=10, **connection(15))
+        self.store_data()
+
+        results = engine.search_json('code')
+        self.assertEqual([r['obj_id'] for r in results], [2, 3])
+        self.assertEqual(engine.local_cache.misses, 1)
+
+        results = engine.search_json('code')
+        self.assertEqual([r['obj_id'] for r in results], [2, 3])
+        self.assertEqual(engine.local_cache.hits, 1)
+
+        # writes made through another engine invalidate the cached results
+        self.engine.store_json(5, 'testing python code', {'obj_id': 5})
+        results = engine.search_json('code')
+        self.assertEqual([r['obj_id'] for r in results], [2, 5, 3])
+        self.assertEqual(engine.local_cache.misses, 2)
+
+        self.engine.remove(2)
+        results = engine.search_json('code', limit=1)
+        self.assertEqual([r['obj_id'] for r in results], [5])
+
+        self.engine.flush()
+        self.assertEqual(engine.search_json('code', limit=1), [])
+
+        # filtered searches are not cached
+        self.engine.store('testing')
+        hits, misses = engine.local_cache.hits, engine.local_cache.misses
+        self.assertEqual(engine.search('testing', filters=[bool]), ['testing'])
+        self.assertEqual((engine.local_cache.hits, engine.local_cache.misses),
+                         (hits, misses))
+
+    def test_cached_intersections(self):
+        self.store_data()
+        self.assertEqual(len(self.engine.search('testing code')), 2)
+
+        # writes change the generation, so new objects show up straight away
+        self.engine.store_json(5, 'python testing code', {'obj_id': 5})
+        self.assertEqual(len(self.engine.search('testing code')), 3)
+        self.engine.remove(5)
+        self.assertEqual(len(self.engine.search('testing code')), 2)
+        cached = self.engine.client.keys(self.engine.cache_prefix + '*')
+        self.assertEqual(len(cached), 3)
+
+        scripted = RedisEngine(prefix='testac', scripted_search=True, **connection(15))
+        self.engine.store_json(5, 'python testing code', {'obj_id': 5})
+        self.assertEqual(len(scripted.search('testing code')), 3)
+
+        # coalesced writes show up once the interval has passed
+        engine = RedisEngine(prefix='testac', coalesce_writes=0.05, **connection(15))
+        generation = engine.generation()
+        engine.store(6, 'testing code')
+        engine.store(7, 'testing code')
+        self.assertEqual(engine.generation(), str(int(generation) + 1))
+        self.assertEqual(len(engine.search('testing code')), 5)
+        engine.store(8, 'testing code')
+        self.assertEqual(len(engine.search('testing code')), 5)
+        time.sleep(.06)
+        self.assertEqual(len(engine.search('testing code')), 6)
+
+    def test_observer(self):
+        events = []
+        engine = RedisEngine(prefix='testac', observer=events.append, **connection(15))
+        engine.store_json(1, 'testing python', {'obj_id': 1})
+        engine.store_many([(2, 'testing python code'), (3, 'web testing code')])
+
+        self.assertEqual([e.operation for e in events], ['store_json', 'store_many'])
+        self.assertEqual((events[0].commands, events[0].round_trips), (14, 1))
+        self.assertTrue(events[0].timings['tokenize'] > 0)
+        self.assertTrue(events[0].timings['score'] > 0)
+        self.assertTrue(events[0].timings['network'] <= events[0].elapsed)
+
+        del events[:]
+        engine.search('testing code')
+        engine.search('testing code', filters=[lambda d: d != 'web testing code'])
+        first, second = events
+        self.assertEqual((first.cache_hits, first.cache_misses), (0, 1))
+        self.assertEqual((second.cache_hits, second.cache_misses), (1, 0))
+        self.assertEqual((first.candidates, first.results), (2, 2))
+        self.assertEqual((second.candidates, second.results), (2, 1))
+        self.assertEqual(first.round_trips, 5)
+        self.assertEqual(second.round_trips, 4)
+
+        collector = HistogramCollector()
+        engine = RedisEngine(prefix='testac', observer=collector, **connection(15))
+        for i in range(10):
+            engine.search('testing')
+        engine.remove(3)
+        summary = collector.summary()
+        self.assertEqual(summary['search']['elapsed']['count'], 10)
+        self.assertEqual(summary['search']['results']['p50'], 3)
+        self.assertTrue(summary['remove']['round_trips']['p99'] >= 2)
+        self.assertEqual(summary['search']['cache_hits'], 0)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.add(i / 1000.)
+        self.assertAlmostEqual(histogram.percentile(50), .5, delta=.005)
+        self.assertAlmostEqual(histogram.percentile(99), .99, delta=.01)
+        self.assertEqual(histogram.percentile(100), 1.)
+        self.assertAlmostEqual(histogram.mean(), .5005)
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2, generation='1')
+        self.assertEqual(cache.get('a'), 1)
+
+        # 'b' is the least recently used, so it is evicted
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b', '1'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+        self.assertEqual(cache.get('c', '2'), None)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        cache.timeout = -1
+        cache.set('d', 4)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_popularity(self):
+        engine = RedisEngine(prefix='testac', popularity_half_life=3600, **connection(15))
+        engine.store_many([(1, 'python'), (2, 'python code', None, 2), (3, 'pyramid')])
+        self.assertEqual(engine.search('py'), ['python code', 'pyramid', 'python'])
+
+        # hits invalidate the cached rankings, including results cached locally,
+        # but not the index generation
+        cached = RedisEngine(prefix='testac', popularity_half_life=3600,
+                             local_cache_size=10, **connection(15))
+        self.assertEqual(cached.search('py', limit=2), ['python code', 'pyramid'])
+        generation = engine.generation()
+        for i in range(3):
+            engine.record_hit(3)
+        self.assertEqual(engine.generation(), generation)
+        self.assertEqual(engine.search('p'), [])
+        self.assertEqual(engine.search('pyr'), ['pyramid'])
+        self.assertEqual(engine.search('py', limit=2), ['pyramid', 'python code'])
+        self.assertEqual(cached.search('py', limit=2), ['pyramid', 'python code'])
+
+        # a boost replaces the recorded hits
+        engine.store(3, 'pyramid', boost=0)
+        engine.record_hit(1)
+        self.assertEqual(engine.search('pyt'), ['python code', 'python'])
+
+        engine.remove(2)
+        self.assertEqual(engine.search('pyth'), ['python'])
+        self.assertEqual(engine.client.zscore(engine.popularity_key, 2), None)
+
+    def test_popularity_ties(self):
+        # objects without a popularity are ordered by title, including those
+        # stored before ranking was enabled
+        self.engine.store_many([('z1', 'apple'), ('a9', 'apricot'), ('m5', 'apex')])
+        engine = RedisEngine(prefix='testac', popularity_half_life=3600, **connection(15))
+        self.assertEqual(engine.search('ap'), ['apex', 'apple', 'apricot'])
+        self.assertEqual(engine.search('ap ap', offset=1), ['apple', 'apricot'])
+
+        engine.store_many([('b1', 'apple tart', None, 2), ('a1', 'apple pie', None, 0)])
+        engine.record_hit('z1')
+        self.assertEqual(engine.search('ap'),
+                         ['apple tart', 'apple', 'apex', 'apple pie', 'apricot'])
+        self.assertEqual(engine.search('ap', offset=1, limit=2), ['apple', 'apex'])
+        self.assertEqual(engine.search_many(['app', 'ap apple']),
+                         [['apple tart', 'apple', 'apple pie'],
+                          ['apple tart', 'apple', 'apple pie']])
+
+    def test_max_per_prefix(self):
+        engine = RedisEngine(prefix='testac', max_per_prefix={2: 3}, **connection(15))
+        titles = ['python %s' % w for w in ('aa', 'bb', 'cc', 'dd', 'ee')]
+        engine.store_many(enumerate(titles))
+
+        self.assertEqual(engine.client.zcard(engine.search_key('py')), 3)
+        self.assertEqual(engine.client.zcard(engine.search_key('pyt')), 5)
+        self.assertEqual(engine.search('pyt'), titles)
+
+        # the truncated set is read while it holds the results asked for, then
+        # the sets of the longer prefixes are read instead
+        self.assertEqual(engine.search('py', limit=2), titles[:2])
+        self.assertFalse(engine.client.keys(engine.cache_prefix + '*'))
+        self.assertEqual(engine.search('py'), titles)
+        self.assertEqual(engine.search('py', offset=3), titles[3:])
+        self.assertEqual(list(engine.search_iter('py', batch_size=2)), titles)
+        self.assertEqual(engine.search_many(['py', 'pyt'], offset=2),
+                         [titles[2:], titles[2:]])
+
+        # and so are they when intersected with other words
+        self.assertEqual(engine.search('py ee'), ['python ee'])
+        self.assertEqual(engine.search('py dd python'), ['python dd'])
+        self.assertEqual(engine.search('py eee'), [])
+
+        self.assertTrue(engine.client.sismember(
+            engine.truncated_key, engine.search_key('py')))
+        self.assertFalse(engine.client.sismember(
+            engine.truncated_key, engine.search_key('pyt')))
+
+        # words that are themselves a capped prefix are indexed under an
+        # untruncated key, and truncated longer prefixes are expanded in turn
+        for kwargs in ({}, {'compact_storage': True, 'intern_ids': True}):
+            engine = RedisEngine(prefix='testac', max_per_prefix=1,
+                                 **dict(connection(15), **kwargs))
+            engine.flush()
+            engine.store_many([(1, 'apple banana'), (2, 'apricot bandana'), (3, 'apple'),
+                               (4, 'ap bag'), (5, 'tea'), (6, 'team'), (7, 'tent')])
+            self.assertEqual(engine.search('ap ba'),
+                             ['ap bag', 'apple banana', 'apricot bandana'])
+            self.assertEqual(engine.search('ba ap', offset=1),
+                             ['apple banana', 'apricot bandana'])
+            self.assertEqual(engine.search('ap bx'), [])
+            self.assertEqual(engine.search('ap'),
+                             ['ap bag', 'apple', 'apple banana', 'apricot bandana'])
+            self.assertEqual(engine.search('te', offset=1), ['team', 'tent'])
+
+            engine.remove(4)
+            engine.update(6, 'ten')
+            self.assertEqual(engine.search('ap', offset=1), ['apple banana', 'apricot bandana'])
+            self.assertEqual(engine.search('te'), ['tea', 'ten', 'tent'])
+
+        # ranked searches are ranked from every matching object
+        engine = RedisEngine(prefix='testac', max_per_prefix=1, popularity_half_life=3600,
+                             **connection(15))
+        engine.flush()
+        engine.store_many([(1, 'apple banana'), (2, 'apricot bandana'), (3, 'apple')])
+        engine.record_hit(2)
+        self.assertEqual(engine.search('ap'),
+                         ['apricot bandana', 'apple', 'apple banana'])
+
+    def test_compact_storage(self):
+        # compressed records are binary, so the client must not decode them
+        engine = RedisEngine(prefix='testac', compact_storage=True, storage_buckets=4,
+                             compress_threshold=50, db=15)
+        engine.store('python')
+        engine.store(2, 'python code', 'some data')
+        engine.store(3, u'python caf\xe9', 'x' * 200)
+        self.assertEqual(engine.search('py'), [b'python', b'x' * 200, b'some data'])
+
+        # a record is kept per object, only the data that differs from the title
+        # is stored and long records are compressed
+        self.assertFalse(engine.client.exists(engine.data_key))
+        self.assertFalse(engine.client.exists(engine.title_key))
+        self.assertEqual(engine.client.hget(engine._record_key('python'), 'python'),
+                         b'=python')
+        record = engine.client.hget(engine._record_key(3), 3)
+        self.assertTrue(record.startswith(b'z') and len(record) < 50)
+        self.assertEqual(engine._decode_record(record),
+                         (u'python caf\xe9'.encode('utf-8'), b'x' * 200))
+
+        engine.remove(2)
+        self.assertEqual(engine.search('python'), [b'python', b'x' * 200])
+        self.assertEqual(sorted(obj_id for obj_id, _ in engine._iter_titles()),
+                         [b'3', b'python'])
+
+        engine.packed_scores = True
+        engine.store_many([(4, 'pythonista abc'), (5, 'pythonista abb')])
+        self.assertEqual(engine.search('pythonista'),
+                         [b'pythonista abb', b'pythonista abc'])
+
+        # uncompressed records can be read by a client that decodes responses
+        engine = RedisEngine(prefix='testac', compact_storage=True, storage_buckets=4,
+                             **connection(15))
+        engine.flush()
+        engine.store(6, u'python caf\xe9', 'some data')
+        self.assertEqual(engine.search('python caf'), ['some data'])
+        self.assertEqual(engine._fetch_data([6]), ['some data'])
+
+    def test_intern_ids(self):
+        engine = RedisEngine(prefix='testac', intern_ids=True, **connection(15))
+        engine.store('python-uuid', 'python', 'python data')
+        engine.store_many([('code-uuid', 'python code'), ('web-uuid', 'web python')])
+        engine.store('python-uuid', 'python', 'new data')
+
+        self.assertEqual(engine.search('python'), ['new data', 'python code', 'web python'])
+        self.assertEqual(sorted(engine.client.zrange(engine.search_key('py'), 0, -1)),
+                         ['1', '2', '3'])
+        self.assertEqual(engine._fetch_data(['web-uuid', 'missing']), ['web python', None])
+        self.assertEqual(sorted(engine._iter_titles()), [
+            ('code-uuid', 'python code'), ('python-uuid', 'python'),
+            ('web-uuid', 'web python')])
+
+        engine.remove_many(['code-uuid', 'missing'])
+        self.assertEqual(engine.search('python'), ['new data', 'web python'])
+        self.assertEqual(engine.client.hlen(engine.intern_forward_key), 2)
+        self.assertEqual(engine.client.hlen(engine.intern_reverse_key), 2)
+
+        # a removed id gets a new integer when it is stored again
+        engine.store('code-uuid', 'python code')
+        self.assertEqual(engine._internal_ids(['code-uuid']), ['4'])
+
+    def test_rebuild(self):
+        engine = RedisEngine(prefix='testac', alias=True, alias_refresh=0, **connection(15))
+        reader = RedisEngine(prefix='testac', alias=True, alias_refresh=60,
+                             **connection(15))
+        engine.client.delete(engine.alias_key, engine.alias_version_key)
+        self.assertRaises(ValueError, self.engine.rebuild, [])
+
+        # without an alias the index is stored under the prefix itself
+        engine.store('python code')
+        self.assertEqual(reader.search('py'), ['python code'])
+        self.assertTrue(self.engine.client.exists(self.engine.title_key))
+
+        stats = engine.rebuild([(1, 'python'), (2, 'pyramid')], drop_delay=.1)
+        self.assertEqual((stats['prefix'], stats['previous_prefix']), ('testac_v1', 'testac'))
+        self.assertEqual(engine.search('py'), ['pyramid', 'python'])
+
+        # engines that have not looked the alias up again keep reading the
+        # previous index until it is dropped
+        self.assertEqual(reader.search('py'), ['python code'])
+        reader._resolved = (0, reader._resolved[1])
+        self.assertEqual(reader.search('py'), ['pyramid', 'python'])
+        stats['drop_thread'].join()
+        self.assertFalse(self.engine.client.keys('testac:*'))
+
+        engine.store(3, 'pylons')
+        stats = engine.rebuild([(1, 'python')], drop_delay=0)
+        stats['drop_thread'].join()
+        self.assertEqual(engine.search('py'), ['python'])
+        self.assertFalse(self.engine.client.keys('testac_v1:*'))
+
+        engine.flush()
+        self.assertEqual(engine.search('py'), [])
+        self.engine.client.delete(engine.alias_key, engine.alias_version_key)
+
+    def test_export_index(self):
+        engine = RedisEngine(prefix='testac', compact_storage=True, storage_buckets=4,
+                             compress_threshold=50, intern_ids=True, max_per_prefix=2,
+                             db=15)
+        engine.store_many((i, 'python %s' % w, 'data %s' % i)
+                          for i, w in enumerate(['aa', 'bb', 'cc', 'dd']))
+        engine.store('cafe', u'caf\xe9 code', 'x' * 200)
+        engine.search('py dd')
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'index')
+        stats = engine.export_index(path, batch_size=2)
+        self.assertEqual(stats['bytes'], os.path.getsize(path))
+
+        # the snapshot can be loaded under another prefix
+        copy = RedisEngine(prefix='testac2', compact_storage=True, storage_buckets=4,
+                           intern_ids=True, max_per_prefix=2, db=15)
+        dump_path = os.path.join(tmp_dir, 'dump')
+        engine.export_index(dump_path, dump=True)
+        for snapshot_path in (path, dump_path):
+            copy.flush()
+            self.assertEqual(copy.import_index(snapshot_path, chunk_size=3)['keys'],
+                             stats['keys'])
+            self.assertFalse(copy.client.keys(copy.cache_prefix + '*'))
+            for phrase in ('py', 'python', 'py dd', 'caf'):
+                self.assertEqual(copy.search(phrase), engine.search(phrase))
+            self.assertEqual(copy.client.smembers(copy.truncated_key),
+                             set(k.replace(b'testac:', b'testac2:') for k in
+                                 engine.client.smembers(engine.truncated_key)))
+            self.assertEqual(copy._fetch_data(['cafe']), [b'x' * 200])
+        copy.flush()
+
+        memory = MemoryEngine()
+        self.assertEqual(memory.load_snapshot(path)['objects'], 5)
+        self.assertEqual(memory.search('py'), [b'data %d' % i for i in range(4)])
+        self.assertEqual(memory.search('caf'), [b'x' * 200])
+        self.assertRaises(ValueError, memory.load_snapshot, dump_path)
+
+        with open(path, 'r+b') as fh:
+            fh.truncate(stats['bytes'] - 1)
+        self.assertRaises(ValueError, list, snapshot.read_snapshot(path))
+        with open(path, 'wb') as fh:
+            fh.write(b'not a snapshot')
+        self.assertRaises(ValueError, copy.import_index, path)
+
+    def test_update(self):
+        self.engine.store(1, 'python code')
+        self.engine.store(2, 'pyramid')
+
+        # storing again leaves the object in the prefix sets of its old title
+        self.engine.store(2, 'web')
+        self.assertEqual(self.engine.search('py'), ['web', 'python code'])
+        self.engine.update(2, 'pyramid')
+        self.assertEqual(self.engine.search('web'), [])
+
+        self.engine.update(1, 'web testing')
+        self.assertEqual(self.engine.search('code'), [])
+        self.assertEqual(self.engine.search('web'), ['web testing'])
+        self.engine.update(1, 'python tests', 'data')
+        self.assertEqual(self.engine.search('web'), [])
+        self.assertEqual(self.engine.search('py'), ['pyramid', 'data'])
+        self.assertEqual(self.engine.search('python tests'), ['data'])
+
+        # only the prefix sets that changed are written to, unless the score
+        # of the title changed
+        self.engine.update(1, 'python tests abcdefghij')
+        self.engine.client.delete(self.engine.search_key('python'))
+        self.engine.update(1, 'python tests abcdefghik')
+        self.assertEqual(self.engine.search('python'), [])
+        self.assertEqual(self.engine.search('abcdefghik'), ['python tests abcdefghik'])
+        self.assertEqual(self.engine.search('abcdefghij'), [])
+        self.engine.update(1, 'python testing')
+        self.assertEqual(self.engine.search('python'), ['python testing'])
+
+        # a new object is simply stored
+        self.engine.update_json(3, 'pylons', {'obj_id': 3})
+        self.assertEqual(self.engine.search_json('pyl'), [{'obj_id': 3}])
+
     def test_removing_objects_in_depth(self):
         # want to ensure that redis is cleaned up and does not become polluted
         # with spurious keys when objects are removed
@@ -154,12 +810,318 @@ class RedisCompletionTestCase(TestCase):
         self.engine.remove(1)
         self.assertEqual(len(redis_client.keys()), initial_key_count)
 
-    def test_clean_phrase(self):
-        self.assertEqual(self.engine.clean_phrase('abc def ghi'), ['abc', 'def', 'ghi'])
+    def test_flush(self):
+        other = RedisEngine(prefix='testac2', **connection(15))
+        other.store('testing other')
+        self.store_data()
 
-        self.assertEqual(self.engine.clean_phrase('a A tHe an a'), [])
-        self.assertEqual(self.engine.clean_phrase(''), [])
+        self.engine.flush(batch_size=3, rate_limit=10000)
+        self.assertEqual(self.engine.search('testing'), [])
+        self.assertEqual(self.engine.client.keys('testac:*'),
+                         [self.engine.generation_key])
 
-        self.assertEqual(
-            self.engine.clean_phrase('The Best of times, the blurst of times'),
-            ['best', 'times', 'blurst', 'times'])
+        # other indexes are left alone
+        self.assertEqual(other.search('testing'), ['testing other'])
+        other.flush()
+
+        # servers without UNLINK fall back to DEL
+        self.store_data()
+        self.engine._use_unlink = False
+        self.engine.flush(batch_size=2)
+        self.assertEqual(self.engine.search('testing'), [])
+
+    def test_remove_many(self):
+        initial_keys = set(self.engine.client.keys())
+        self.store_data()
+
+        self.engine.remove_many([1, 3, 'missing'], chunk_size=2)
+        results = self.engine.search_json('testing')
+        self.assertEqual([r['obj_id'] for r in results], [2])
+
+        self.engine.remove_many([2, 4])
+        self.assertEqual(self.engine.search('testing'), [])
+        self.assertEqual(set(self.engine.client.keys()), initial_keys)
+
+    def test_transaction_attempts(self):
+        # a transaction whose titles are always written to concurrently gives up
+        self.engine.store(1, 'python code')
+        writer = RedisEngine(prefix='testac', **connection(15))
+        get_payloads = self.engine._get_payloads
+        def racing(*args, **kwargs):
+            writer.store('racing')
+            return get_payloads(*args, **kwargs)
+        self.engine._get_payloads = racing
+
+        self.assertRaises(WatchError, self.engine.remove, 1)
+        self.assertRaises(WatchError, self.engine.update, 1, 'pyramid')
+        self.assertEqual(self.engine.search('py'), ['python code'])
+
+        self.engine._get_payloads = get_payloads
+        self.engine.remove(1)
+        self.assertEqual(self.engine.search('py'), [])
+
+
+class MemoryEngineTestCase(EngineTests, TestCase):
+    def get_engine(self, **kwargs):
+        return MemoryEngine(**kwargs)
+
+    def test_store_replaces(self):
+        self.engine.store(1, 'python code')
+        self.engine.store(1, 'web testing', 'data')
+        self.assertEqual(self.engine.search('py'), [])
+        self.assertEqual(self.engine.search('web'), ['data'])
+        self.engine.update_json(1, 'pylons', {'obj_id': 1})
+        self.assertEqual(self.engine.search_json('py'), [{'obj_id': 1}])
+
+        # duplicates within a batch replace each other too
+        self.engine.store_many([(2, 'python'), (3, 'pyramid'), (2, 'perl')])
+        self.assertEqual(self.engine.search('p'), [])
+        self.assertEqual(self.engine.search('py'), ['{"obj_id": 1}', 'pyramid'])
+        self.assertEqual(self.engine.search('pe'), ['perl'])
+
+    def test_remove_many(self):
+        self.store_data()
+        self.engine.remove_many([1, 3, 'missing'], chunk_size=2)
+        self.assertEqual([r['obj_id'] for r in self.engine.search_json('testing')], [2])
+
+        # nothing is left behind once every object is removed
+        self.engine.remove_many([2, 4])
+        self.assertEqual(self.engine.search('testing'), [])
+        self.assertEqual((self.engine._objects, self.engine._index), ({}, {}))
+
+    def test_cached_intersections(self):
+        self.store_data()
+        self.assertEqual(len(self.engine.search('testing code')), 2)
+        self.assertEqual(len(self.engine.search('testing code')), 2)
+        self.assertEqual(self.engine._intersections.hits, 1)
+
+        self.engine.store_json(5, 'python testing code', {'obj_id': 5})
+        self.assertEqual(len(self.engine.search('testing code')), 3)
+        self.engine.flush()
+        self.assertEqual(self.engine.search('testing code'), [])
+
+
+class ShardedEngineTestCase(TestCase):
+    def setUp(self):
+        self.engine = ShardedEngine({'a': connection(14), 'b': connection(15)},
+                                    prefix='testac')
+        self.engine.flush()
+        RedisEngine(prefix='testac', **connection(13)).flush()
+
+        self.strings = []
+        for i in range(26):
+            self.strings.append('aaaa%s' % chr(i + ord('a')))
+            if i > 0:
+                self.strings.append('aaa%sa' % chr(i + ord('a')))
+        random.shuffle(self.strings)
+
+    def assertPlacement(self):
+        for name, engine in self.engine.engines.items():
+            obj_ids = engine.client.hkeys(engine.title_key)
+            self.assertTrue(obj_ids)
+            for obj_id in obj_ids:
+                self.assertEqual(self.engine.ring.get_node(obj_id), name)
+
+    def test_search(self):
+        stats = self.engine.store_many(((s,) for s in self.strings), chunk_size=10)
+        self.assertEqual(stats['objects'], len(self.strings))
+        self.assertPlacement()
+
+        expected = sorted(self.strings)
+        self.assertEqual(self.engine.search('aaa'), expected)
+        self.assertEqual(self.engine.search('aaa', limit=30), expected[:30])
+        self.assertEqual(self.engine.search('aaa', limit=5, offset=20), expected[20:25])
+        self.assertEqual(self.engine.search('aaa', filters=[lambda s: s.endswith('a')],
+                                            limit=3),
+                         [s for s in expected if s.endswith('a')][:3])
+        self.assertEqual(self.engine.search('aaaaz'), ['aaaaz'])
+        self.assertEqual(self.engine.search('missing'), [])
+
+        self.engine.store_json(1, 'testing python', {'obj_id': 1})
+        self.assertEqual(self.engine.search_json('testing'), [{'obj_id': 1}])
+
+    def test_remove(self):
+        self.engine.store_many((s,) for s in self.strings)
+        removed = self.strings[:10]
+        self.engine.remove_many(removed[1:])
+        self.engine.remove(removed[0])
+        self.assertEqual(self.engine.search('aaa'), sorted(self.strings[10:]))
+
+    def test_add_node_intern_ids(self):
+        engine = ShardedEngine({'a': connection(14)}, prefix='testac', intern_ids=True)
+        engine.store_many(('id%s' % i, 'python %s' % i) for i in range(20))
+        engine.add_node('b', connection(13))
+        self.assertEqual(len(engine.search('python')), 20)
+        self.assertTrue(0 < engine.engines['b'].client.hlen(
+            engine.engines['b'].intern_forward_key) < 20)
+
+    def test_packed_score_ties(self):
+        titles = ['abcdefghijkl%s' % c for c in 'abcdefgh'] + ['abcdefghijz', 'abd']
+        sharded = ShardedEngine({'a': connection(14), 'b': connection(15)},
+                                prefix='testac2', packed_scores=True, batch_size=3)
+        sharded.store_many((-i, title) for i, title in enumerate(titles))
+        self.assertEqual(sharded.search('ab'), titles)
+        sharded.flush()
+
+    def test_add_node(self):
+        self.engine.store_many((s,) for s in self.strings)
+        moved = self.engine.add_node('c', connection(13))
+
+        self.assertTrue(0 < moved < len(self.strings))
+        self.assertPlacement()
+        self.assertEqual(self.engine.search('aaa'), sorted(self.strings))
+        self.assertEqual(self.engine.rebalance(), 0)
+
+
+class ReplicatedEngineTestCase(TestCase):
+    def setUp(self):
+        self.writer = RedisEngine(prefix='testac', publish_changes=True, **connection(15))
+        self.writer.flush()
+        self.writer.store_many([(1, 'testing python'), (2, 'web testing')])
+        self.engine = ReplicatedEngine(prefix='testac', poll_interval=.05, **connection(15))
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_search(self):
+        self.assertEqual(self.engine.search('testing'), ['testing python', 'web testing'])
+
+        self.engine.store(3, 'testing code')
+        self.engine.update_json(1, 'python', {'obj_id': 1})
+        self.writer.remove(2)
+        self.assertTrue(self.engine.catch_up())
+        self.assertEqual(self.engine.search('testing'), ['testing code'])
+        self.assertEqual(self.engine.search_json('py'), [{'obj_id': 1}])
+
+        self.engine.store_many(((i, 'python %s' % i) for i in range(10)), chunk_size=10)
+        self.assertTrue(self.engine.catch_up())
+        self.assertEqual(self.engine.search('python', limit=3),
+                         ['python 0', 'python 1', 'python 2'])
+
+        self.engine.flush()
+        self.assertTrue(self.engine.catch_up())
+        self.assertEqual(self.engine.search('python'), [])
+        self.assertEqual(self.engine.reloads, 1)
+
+    def test_missed_change(self):
+        # a change whose message is lost is noticed when the next one arrives
+        self.writer.client.incr(self.writer.sequence_key)
+        self.writer.store(3, 'testing code')
+        self.assertTrue(self.engine.catch_up())
+        self.assertEqual(self.engine.search('code'), ['testing code'])
+        self.assertEqual(self.engine.reloads, 2)
+
+        # or, if it was the last change, once the engine has polled the sequence
+        self.writer.client.incr(self.writer.sequence_key)
+        RedisEngine(prefix='testac', **connection(15)).store(4, 'web code')
+        self.assertTrue(self.engine.catch_up())
+        self.assertEqual(self.engine.search('code'), ['testing code', 'web code'])
+        self.assertEqual(self.engine.reloads, 3)
+
+    def test_bad_message(self):
+        # a message that can't be read, or a change that can't be applied, is
+        # logged and the copy reloaded
+        sequence = self.engine.sequence
+        with self.assertLogs('redis_completion.replicated') as logs:
+            self.writer.client.publish(self.writer.changes_channel, 'garbage')
+            self.writer.store(3, 'testing code')
+            self.assertTrue(self.engine.catch_up())
+            self.writer.client.publish(self.writer.changes_channel,
+                                       '%d [["store", 4]]' % (sequence + 2))
+            self.writer.store(4, 'web code')
+            self.assertTrue(self.engine.catch_up())
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertTrue(self.engine._thread.is_alive())
+        self.assertEqual(self.engine.search('code'), ['testing code', 'web code'])
+        self.assertEqual(self.engine.reloads, 3)
+
+    def test_rebuild(self):
+        engine = ReplicatedEngine(prefix='testac3', alias=True, alias_refresh=0,
+                                  poll_interval=.05, **connection(15))
+        writer = engine.engine
+        writer.client.delete(writer.alias_key, writer.alias_version_key)
+        engine.store('python code')
+
+        # the copy is reloaded once the alias points at the new index
+        engine.rebuild([(1, 'pyramid')], background=False, drop_delay=0)
+        self.assertTrue(engine.catch_up())
+        self.assertEqual((engine.search('py'), engine.reloads), (['pyramid'], 2))
+        engine.store(2, 'pylons')
+        self.assertTrue(engine.catch_up())
+        self.assertEqual(engine.search('py'), ['pylons', 'pyramid'])
+
+        engine.close()
+        engine.flush()
+        writer.client.delete(writer.alias_key, writer.alias_version_key)
+
+
+@skipIf(AsyncRedisEngine is None, 'redis.asyncio is not available')
+class AsyncRedisEngineTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.engine = AsyncRedisEngine(prefix='testac', db=15)
+        self.run_async(self.engine.flush())
+
+    def tearDown(self):
+        self.run_async(self.engine.client.aclose())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def store_data(self):
+        test_data = (
+            (1, 'testing python'),
+            (2, 'testing python code'),
+            (3, 'web testing python code'),
+            (4, 'unit tests with python'),
+        )
+        for obj_id, title in test_data:
+            self.run_async(self.engine.store_json(obj_id, title, {
+                'obj_id': obj_id,
+                'title': title,
+            }))
+
+    def search_ids(self, phrase, **kwargs):
+        results = self.run_async(self.engine.search_json(phrase, **kwargs))
+        return [r['obj_id'] for r in results]
+
+    def test_search(self):
+        self.store_data()
+
+        self.assertEqual(self.search_ids('testing python'), [1, 2, 3])
+        self.assertEqual(self.search_ids('test'), [1, 2, 4, 3])
+        self.assertEqual(self.search_ids('test', limit=2, offset=1), [2, 4])
+        self.assertEqual(self.search_ids('python', filters=[
+            lambda i: i['obj_id'] % 2 == 0]), [2, 4])
+        self.assertEqual(self.search_ids(''), [])
+        self.assertEqual(self.search_ids('missing'), [])
+        self.assertRaises(ValueError, AsyncRedisEngine, packed_scores=True)
+
+        # single words are read from their prefix set without intersecting it
+        ttl = self.run_async(self.engine.client.ttl(self.engine.search_key('test')))
+        self.assertEqual(ttl, -1)
+
+    def test_concurrent_search(self):
+        self.store_data()
+
+        results = self.run_async(asyncio.gather(*[
+            self.engine.search_json(phrase)
+            for phrase in ('testing python', 'unit', 'code', 'testing python')]))
+        self.assertEqual([[r['obj_id'] for r in result] for result in results],
+                         [[1, 2, 3], [4], [2, 3], [1, 2, 3]])
+
+    def test_remove(self):
+        self.store_data()
+
+        self.run_async(self.engine.remove(2))
+        self.assertEqual(self.search_ids('code'), [3])
+        self.run_async(self.engine.remove(3))
+        self.assertEqual(self.search_ids('code'), [])
+        self.assertEqual(self.search_ids('testing'), [1])
+
+        self.run_async(self.engine.flush())
+        self.assertEqual(self.search_ids('python'), [])
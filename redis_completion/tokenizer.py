@@ -0,0 +1,55 @@
+import re
+
+
+class Tokenizer(object):
+    """
+    Splits phrases into words and words into the prefixes they are indexed
+    under.  The prefixes of recently seen words are cached, as titles tend to
+    share a limited vocabulary.
+    """
+    # the characters left in a word once a phrase is cleaned
+    characters = 'abcdefghijklmnopqrstuvwxyz0123456789_-'
+
+    def __init__(self, min_length=2, stop_words=None, cache_size=10000):
+        self.min_length = min_length
+        self.stop_words = stop_words or set()
+        self.cache_size = cache_size
+
+        self._strip = re.compile(r'[^a-z0-9_\-\s]')
+        self._prefixes = {}
+
+    def _words(self, phrase):
+        return [w for w in phrase.split() if w not in self.stop_words]
+
+    def tokenize(self, phrase):
+        return self._words(self._strip.sub('', phrase.lower()))
+
+    def tokenize_many(self, phrases):
+        """
+        Tokenize a list of phrases, cleaning all of them with a single pass
+        of the regular expression
+        """
+        if not phrases:
+            return []
+        joined = '\n'.join(phrase.replace('\n', ' ') for phrase in phrases)
+        lines = self._strip.sub('', joined.lower()).split('\n')
+        return [self._words(line) for line in lines]
+
+    def prefixes(self, word):
+        try:
+            return self._prefixes[word]
+        except KeyError:
+            pass
+
+        ml = self.min_length
+        prefixes = tuple(word[:i] for i in range(ml, len(word))) + (word,)
+        if len(self._prefixes) >= self.cache_size:
+            self._prefixes.clear()
+        self._prefixes[word] = prefixes
+        return prefixes
+
+    def partial_keys(self, words):
+        keys = set()
+        for word in words:
+            keys.update(self.prefixes(word))
+        return keys
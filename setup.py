@@ -10,6 +10,8 @@ setup(
     author_email='coleifer@gmail.com',
     url='http://github.com/coleifer/redis-completion/tree/master',
     packages=find_packages(),
+    python_requires='>=3.6',
+    install_requires=['redis>=4.2'],
     package_data = {
         'redis_completion': [
         ],